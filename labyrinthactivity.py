@@ -21,7 +21,7 @@ import os
 import shutil
 import time
 from gettext import gettext as _
-import xml.dom.minidom as dom
+from xml.etree import ElementTree
 
 import cairo
 
@@ -62,6 +62,7 @@ sys.path.append(os.path.join(activity.get_bundle_path(), 'src'))
 import UndoManager
 import MMapArea
 import utils
+from SaveThread import SaveThread
 
 EMPTY = -800
 
@@ -668,6 +669,7 @@ class ActionButtons():
 class LabyrinthActivity(activity.Activity):
     def __init__(self, handle):
         activity.Activity.__init__(self, handle)
+        self._save_thread = None
 
         if HASTOOLBARBOX:
             self.max_participants = 1
@@ -1019,21 +1021,25 @@ class LabyrinthActivity(activity.Activity):
     def read_file(self, file_path):
         tar = Tarball(file_path)
 
-        doc = dom.parseString(tar.read(tar.getnames()[0]))
-        top_element = doc.documentElement
+        # The manifest is parsed as a stream: thoughts and links are
+        # created while it is read and their elements dropped right away
+        manifest = tar.open(tar.getnames()[0])
+        events = ElementTree.iterparse(manifest, events=('start', 'end'))
+        event, top_element = next(events)
 
-        self.set_title(top_element.getAttribute("title"))
-        self._mode = int(top_element.getAttribute("mode"))
+        self.set_title(top_element.get("title"))
+        self._mode = int(top_element.get("mode"))
 
         self._main_area.set_mode(self._mode)
-        self._main_area.load_thyself(top_element, doc, tar)
+        self._main_area.load_thyself(top_element, events, tar)
+        manifest.close()
 
-        if top_element.hasAttribute("scale_factor"):
-            fac = float(top_element.getAttribute("scale_factor"))
+        if "scale_factor" in top_element.attrib:
+            fac = float(top_element.get("scale_factor"))
             self._main_area.scale_fac = fac
 
-        if top_element.hasAttribute("translation"):
-            tmp = top_element.getAttribute("translation")
+        if "translation" in top_element.attrib:
+            tmp = top_element.get("translation")
             x, y = utils.parse_coords(tmp)
             self._main_area.translation = [x, y]
 
@@ -1044,28 +1050,38 @@ class LabyrinthActivity(activity.Activity):
 ##############
 
     def write_file(self, file_path):
-        
-        tar = Tarball(file_path, 'w')
-
-        self._main_area.update_save()
-        manifest = self.serialize_to_xml(self._main_area.save,
-                self._main_area.element)
-        tar.write('MANIFEST', manifest)
-        self._main_area.save_thyself(tar)
-
-        tar.close()
-
-    def serialize_to_xml(self, doc, top_element):
-        top_element.setAttribute("title", self.props.title)
-        top_element.setAttribute("mode", str(self._mode))
-        top_element.setAttribute("size", str((400, 400)))
-        top_element.setAttribute("position", str((0, 0)))
-        top_element.setAttribute("maximised", str(True))
-        top_element.setAttribute("view_type", str(0))
-        top_element.setAttribute("pane_position", str(500))
-        top_element.setAttribute("scale_factor",
-                                 str(self._main_area.scale_fac))
-        top_element.setAttribute("translation",
-                                 str(self._main_area.translation))
-        string = doc.toxml()
-        return string.encode("utf-8")
+        # Only take records of what changed out of the map here; the
+        # XML, the images and the archive are made on the save thread
+        # while the main loop keeps running.  A save requested from
+        # within that loop waits without running it again (see
+        # SaveThread.wait)
+        attrs = self.get_manifest_attributes()
+        files = self._main_area.get_save_files()
+        fragments = self._main_area.get_save_fragments()
+
+        def write(path):
+            tar = Tarball(path, 'w', compression=utils.save_compression)
+            tar.write('MANIFEST',
+                      utils.save_fragments_to_xml("MMap", attrs, fragments))
+            # Images are compressed already
+            for name, data in files:
+                tar.write(name, data, compress=False)
+            tar.close()
+
+        if self._save_thread is None:
+            self._save_thread = SaveThread()
+            self._save_thread.start()
+        job = self._save_thread.save(file_path, write)
+        # Sugar expects the file to be there once write_file returns
+        self._save_thread.wait(job)
+
+    def get_manifest_attributes(self):
+        return [("title", self.props.title),
+                 ("mode", str(self._mode)),
+                 ("size", str((400, 400))),
+                 ("position", str((0, 0))),
+                 ("maximised", str(True)),
+                 ("view_type", str(0)),
+                 ("pane_position", str(500)),
+                 ("scale_factor", str(self._main_area.scale_fac)),
+                 ("translation", str(tuple(self._main_area.translation)))]
@@ -14,14 +14,12 @@
 
 """Simplify tarfile module usage"""
 
-import os
+import io
+import mmap
 import time
 import tarfile
-##import cStringIO
-from io import StringIO
+from io import BytesIO
 import zipfile
-import tempfile
-import shutil
 
 from gi.repository import Gtk
 from gi.repository import GdkPixbuf
@@ -35,16 +33,168 @@ class BadDataTypeError(TarballError):
     """Exception for unsupported data type in read/write methods."""
     pass
 
+# Size of the pieces members are handed to pixbuf loaders in
+CHUNK_SIZE = 64 * 1024
+
+# Compression methods for Tarball(..., compression=...).  Compressed
+# archives are written as zip files, which compress each member on its
+# own, so members that are compressed already can be stored as they are.
+COMPRESSIONS = {'gzip': zipfile.ZIP_DEFLATED}
+if hasattr(zipfile, 'ZIP_BZIP2'):
+    COMPRESSIONS['bzip2'] = zipfile.ZIP_BZIP2
+if hasattr(zipfile, 'ZIP_LZMA'):
+    COMPRESSIONS['xz'] = zipfile.ZIP_LZMA
+
+class _MemberReader(io.RawIOBase):
+    """File object reading a member straight out of a memory map."""
+
+    def __init__(self, view):
+        io.RawIOBase.__init__(self)
+        self.__view = view
+        self.__pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        count = min(len(buf), len(self.__view) - self.__pos)
+        buf[:count] = self.__view[self.__pos:self.__pos + count]
+        self.__pos += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.__view.release()
+        io.RawIOBase.close(self)
+
+class _TarBackend:
+    """Reads and writes members of a tar file.
+
+    When reading, the archive is memory mapped if possible, and members
+    are served as slices of the map rather than copied out of the file."""
+
+    def __init__(self, name, mode):
+        self.__file = None
+        self.__map = None
+        if mode == 'r':
+            self.__file = open(name, 'rb')
+            try:
+                self.__map = mmap.mmap(self.__file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                self.__map = None
+            self.__tar = tarfile.TarFile(fileobj=self.__file, mode=mode)
+        else:
+            self.__tar = tarfile.TarFile(name=name, mode=mode)
+        # name -> TarInfo, built on the first lookup.  tarfile itself
+        # searches its member list for every name.
+        self.__members = None
+
+    def __get_members(self):
+        if self.__members is None:
+            self.__members = {}
+            if self.__tar.mode in ('r', 'a'):
+                for info in self.__tar.getmembers():
+                    # As in tarfile, a later member of the same name wins
+                    self.__members[info.name] = info
+        return self.__members
+
+    def getnames(self):
+        return self.__tar.getnames()
+
+    def exists(self, arcname):
+        return arcname in self.__get_members()
+
+    def __get_member(self, arcname):
+        member = self.__get_members().get(arcname)
+        if member is None:
+            raise KeyError(arcname)
+        return member
+
+    def view(self, arcname):
+        member = self.__get_member(arcname)
+        if self.__map is None or not member.isfile():
+            return None
+        return memoryview(self.__map)[member.offset_data:
+                                      member.offset_data + member.size]
+
+    def open(self, arcname):
+        view = self.view(arcname)
+        if view is None:
+            return self.__tar.extractfile(self.__get_member(arcname))
+        return _MemberReader(view)
+
+    def add(self, info, data, compress):
+        info.size = len(data)
+        self.__tar.addfile(info, BytesIO(data))
+        self.__get_members()[info.name] = info
+
+    def close(self):
+        self.__tar.close()
+        if self.__map is not None:
+            try:
+                self.__map.close()
+            except BufferError:
+                # Someone still holds a slice; the map goes with it
+                pass
+        if self.__file is not None:
+            self.__file.close()
+
+class _ZipBackend:
+    """Reads members of a zip file in place, or writes a zip file
+    compressed with the given zipfile method."""
+
+    def __init__(self, name, mode='r', compression=zipfile.ZIP_STORED):
+        self.__zip = zipfile.ZipFile(name, mode)
+        self.__compression = compression
+
+    def getnames(self):
+        return self.__zip.namelist()
+
+    def exists(self, arcname):
+        try:
+            self.__zip.getinfo(arcname)
+            return True
+        except KeyError:
+            return False
+
+    def view(self, arcname):
+        self.__zip.getinfo(arcname)
+        return None
+
+    def open(self, arcname):
+        # Like tarfile, raise KeyError for unknown members and return
+        # None for directories
+        info = self.__zip.getinfo(arcname)
+        if arcname.endswith('/'):
+            return None
+        return self.__zip.open(info)
+
+    def add(self, info, data, compress):
+        zinfo = zipfile.ZipInfo(info.name, time.localtime(info.mtime)[:6])
+        zinfo.external_attr = info.mode << 16
+        if compress:
+            zinfo.compress_type = self.__compression
+        else:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        self.__zip.writestr(zinfo, data)
+
+    def close(self):
+        self.__zip.close()
+
 class Tarball:
     """
     Wrap standart tarfile module to simplify read/write operations with
     most popular data types.
 
-    In read mode Tarball can load zip files as well.
+    In read mode Tarball can load zip files as well.  In write mode,
+    passing one of the COMPRESSIONS names as compression writes a zip
+    file instead, compressing the members written with compress=True.
 
     Supprted types:
 
         * string
+        * bytes, stored as they are
         * GdkPixbuf.Pixbuf
 
     Write usage:
@@ -60,6 +210,11 @@ class Tarball:
         # write pixbuf to file in tarball
         tar.write('name within tarball', pixbuf_object)
 
+        # or, in a compressed tarball, write data that is compressed
+        # already as it is
+        tar = Tarball(tarfile, 'w', compression='gzip')
+        tar.write('name within tarball', png_bytes, compress=False)
+
         # save and close tarball file
         tar.close()
 
@@ -71,38 +226,31 @@ class Tarball:
         # read content of file in tarball to string
         str_content = tar.read('name within tarball')
 
+        # or read it as a stream
+        file_o = tar.open('name within tarball')
+
+        # check for a file in tarball
+        if tar.exists('name within tarball'):
+            ...
+
         # read content of file in tarball to pixbuf object
         pixbuf_content = tar.read_pixbuf('name within tarball')
     """
 
-    def __init__(self, name=None, mode='r', mtime=None):
-        if not mode.startswith('r') or tarfile.is_tarfile(name):
-            self.__tar = tarfile.TarFile(name=name, mode=mode)
-
-        else:
-            # convert for tar
-
-            if not zipfile.is_zipfile(name):
-                raise tarfile.ReadError()
-
-            try:
-                tmp_dir = tempfile.mkdtemp()
-                tmp_fd, tmp_name = tempfile.mkstemp()
-                tmp_fo = os.fdopen(tmp_fd, 'w')
-
-                zip = zipfile.ZipFile(name)
-                zip.extractall(tmp_dir)
+    def __init__(self, name=None, mode='r', mtime=None, compression=None):
+        if compression and not mode.startswith('r'):
+            if compression not in COMPRESSIONS:
+                raise TarballError('Unknown compression %s' % compression)
+            self.__backend = _ZipBackend(name, mode, COMPRESSIONS[compression])
 
-                tar = tarfile.TarFile(fileobj=tmp_fo, mode='w')
-                tar.add(tmp_dir, arcname='')
-                tar.close()
+        elif not mode.startswith('r') or tarfile.is_tarfile(name):
+            self.__backend = _TarBackend(name, mode)
 
-                self.__tar = tarfile.TarFile(name=tmp_name, mode=mode)
+        elif zipfile.is_zipfile(name):
+            self.__backend = _ZipBackend(name)
 
-            finally:
-                tmp_fo.close()
-                os.unlink(tmp_name)
-                shutil.rmtree(tmp_dir)
+        else:
+            raise tarfile.ReadError()
 
         if mtime:
             self.mtime = mtime
@@ -112,15 +260,21 @@ class Tarball:
 
     def close(self):
         """Save(if 'r' mode was given) and close tarball file."""
-        self.__tar.close()
+        self.__backend.close()
 
     def getnames(self):
         """Return names of members sorted by creation order."""
-        return self.__tar.getnames()
+        return self.__backend.getnames()
 
     def read(self, arcname):
         """Returns sring with content of given file from tarball."""
-        file_o = self.__tar.extractfile(arcname.encode('utf8'))
+        view = self.__backend.view(arcname)
+        if view is not None:
+            out = view.tobytes()
+            view.release()
+            return out
+
+        file_o = self.__backend.open(arcname)
         if not file_o:
             return None
 
@@ -128,24 +282,64 @@ class Tarball:
         file_o.close()
         return out
 
+    def view(self, arcname):
+        """Returns a memoryview of the content of given file, taken
+        straight from the memory mapped tarball, or None if the tarball
+        isn't mapped.  The map stays open for as long as views of it
+        are held, even after the tarball is closed."""
+        return self.__backend.view(arcname)
+
+    def read_buffer(self, arcname):
+        """Returns the content of given file without copying it where
+        possible: a memoryview of the memory mapped tarball if there is
+        one (see view), the bytes read out of the tarball otherwise."""
+        view = self.view(arcname)
+        if view is not None:
+            return view
+        return self.read(arcname)
+
+    def exists(self, arcname):
+        """Returns whether the tarball has a member of the given name,
+        including ones written to it."""
+        return self.__backend.exists(arcname)
+
+    def open(self, arcname):
+        """Returns file object for reading given file from tarball.
+        The member is read from the archive as the object is read, not
+        copied up front."""
+        return self.__backend.open(arcname)
+
     def read_pixbuf(self, arcname):
         """Returns pixbuf object of given file from tarball."""
-        loader = GdkPixbuf.PixbufLoader.new_with_mime_type('image/png')
-        loader.write(self.read(arcname))
+        loader = GdkPixbuf.PixbufLoader()
+        view = self.view(arcname)
+        if view is None:
+            loader.write(self.read(arcname))
+        else:
+            # The loader takes buffers, so it reads the pieces straight
+            # out of the map
+            for start in range(0, len(view), CHUNK_SIZE):
+                loader.write(view[start:start + CHUNK_SIZE])
+            view.release()
         loader.close()
         return loader.get_pixbuf()
 
-    def write(self, arcname, data, mode=0o644):
+    def write(self, arcname, data, mode=0o644, compress=True):
         """
         Stores given object to file in tarball.
+        compress only matters for compressed tarballs; pixbufs are
+        stored as PNG and never compressed again.
         Raises BadDataTypeError exception If data type isn't supported.
         """
-        info = tarfile.TarInfo(arcname.encode('utf8'))
+        info = tarfile.TarInfo(arcname)
         info.mode = mode
         info.mtime = self.mtime
 
-        if isinstance(data, str):
-            self.__write_str(info, data)
+        if isinstance(data, (bytes, memoryview)):
+            self.__write_bytes(info, data, compress)
+
+        elif isinstance(data, str):
+            self.__write_bytes(info, data.encode('utf8'), compress)
 
         elif isinstance(data, GdkPixbuf.Pixbuf):
             self.__write_pixbuf(info, data)
@@ -153,17 +347,9 @@ class Tarball:
         else:
             raise BadDataTypeError()
 
-    def __write_str(self, info, data):
-        info.size = len(data)
-        self.__tar.addfile(info, StringIO.StringIO(data))
+    def __write_bytes(self, info, data, compress):
+        self.__backend.add(info, data, compress)
         
     def __write_pixbuf(self, info, data):
-        def push(pixbuf, buffer):
-            buffer.write(pixbuf)
-
-        buffer = StringIO.StringIO()
-        data.save_to_callback(push, 'png', user_data=buffer)
-
-        info.size = buffer.tell()
-        buffer.seek(0)
-        self.__tar.addfile(info, buffer)
+        success, buffer = data.save_to_bufferv('png', [], [])
+        self.__write_bytes(info, buffer, False)
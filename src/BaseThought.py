@@ -24,6 +24,10 @@ from gi.repository import Gdk
 from gi.repository import Pango
 from gi.repository import GObject
 
+import math
+import cairo
+from collections import OrderedDict
+
 import utils
 
 import TextBufferMarkup
@@ -35,6 +39,55 @@ UNDO_ERASE = 2
 
 MIN_SIZE = 20
 
+# Extra room (in canvas units) around a thought's cached rendering for
+# the outline's line width and antialiasing
+RENDER_PADDING = 4
+# Bytes the cached renderings of all thoughts may take together
+RENDER_CACHE_BUDGET = 24 * 1024 * 1024
+# Zoomed in further than this, thoughts are drawn directly: their
+# surfaces would grow with the square of the scale
+RENDER_CACHE_MAX_SCALE = 2.0
+
+class RenderCaches:
+    ''' Keeps track of the thoughts holding a cached rendering.  When \
+        the surfaces take more than the budget, the caches of the \
+        thoughts drawn least recently are dropped, but never those of \
+        thoughts drawn during the current pass'''
+
+    def __init__ (self, budget = RENDER_CACHE_BUDGET):
+        self.budget = budget
+        # thought -> (bytes, pass it was last drawn in)
+        self.entries = OrderedDict ()
+        self.size = 0
+        self.current_pass = 0
+
+    def begin_pass (self):
+        self.current_pass += 1
+
+    def touch (self, thought, size):
+        self.forget (thought)
+        self.entries[thought] = (size, self.current_pass)
+        self.size += size
+        while self.size > self.budget:
+            oldest = next (iter (self.entries))
+            if oldest is thought or self.entries[oldest][1] == self.current_pass:
+                break
+            oldest.drop_render_cache ()
+
+    def forget (self, thought):
+        old = self.entries.pop (thought, None)
+        if old:
+            self.size -= old[0]
+
+    def drop_outside (self, x0, y0, x1, y1):
+        ''' Drops the caches of thoughts that lie outside the rectangle '''
+        for thought in list (self.entries):
+            if not thought.ul or not thought.lr or thought.lr[0] < x0 or \
+               thought.ul[0] > x1 or thought.lr[1] < y0 or thought.ul[1] > y1:
+                thought.drop_render_cache ()
+
+render_caches = RenderCaches ()
+
 DEFAULT_WIDTH    = 100
 DEFAULT_HEIGHT    = 70
 
@@ -77,9 +130,8 @@ class BaseThought (GObject.GObject):
     # The first thing that should be called is this constructor
     # It sets some basic properties of all thoughts and should be called
     # before you start doing you're own thing with thoughts
-    # save: the save document passed into the derived constructor
     # elem_type: a string representing the thought type (e.g. "image_thought")
-    def __init__ (self, save, elem_type, undo, background_color, foreground_color):
+    def __init__ (self, elem_type, undo, background_color, foreground_color):
         # Note: Once the thought has been successfully initialised (i.e. at the end
         # of the constructor) you MUST set all_okay to True
         # Otherwise, bad things will happen.
@@ -98,19 +150,53 @@ class BaseThought (GObject.GObject):
         self.background_color = background_color
         self.foreground_color = foreground_color
         self.model_iter = None
-        extended_elem = save.createElement ("Extended")
-        self.extended_buffer = TextBufferMarkup.ExtendedBuffer (self.undo, extended_elem, save)
+        # Bumped whenever what the thought draws changes.  Together with
+        # the scale and state it keys the cached rendering (see draw_cached)
+        self.content_version = 0
+        self.render_cache = None
+        # The utils.SaveFragment from the last save
+        self.save_cache = None
+        self.extended_buffer = TextBufferMarkup.ExtendedBuffer (self.undo)
         self.extended_buffer.set_text("")
         self.extended_buffer.connect ("set_focus", self.focus_buffer)
         self.extended_buffer.connect ("set_attrs", self.set_extended_attrs)
-        self.element = save.createElement (elem_type)
-        self.element.appendChild (extended_elem)
+        self.elem_type = elem_type
         self.creating = True
 
     # These are self-explanitory.  You probably don't want to
     # overwrite these methods, unless you have a very good reason
-    def get_save_element (self):
-        return self.element
+    def get_state_attributes (self):
+        ''' The save attributes marking the thought as selected/primary '''
+        attrs = []
+        if self.am_selected:
+            attrs.append (("current_root", "true"))
+        if self.am_primary:
+            attrs.append (("primary_root", "true"))
+        return attrs
+
+    def get_extended_records (self):
+        ''' The save records for the extended notes, if there are any '''
+        if not self.extended_buffer.get_text ():
+            return []
+        return [self.extended_buffer.get_save_record ()]
+
+    def get_save_key (self):
+        ''' A cheap summary of everything get_save_record depends on.  \
+            Derived thoughts saving more state than this must add it, or \
+            call content_changed when it changes'''
+        return (self.content_version, self.extended_buffer.version,
+                self.ul, self.lr, self.identity, self.index, self.text,
+                self.am_selected, self.am_primary,
+                utils.color_to_string (self.background_color),
+                self.foreground_color and utils.color_to_string (self.foreground_color))
+
+    def get_save_fragment (self):
+        ''' The thought as a utils.SaveFragment.  A new one is only made \
+            when the thought changed since the last save '''
+        key = self.get_save_key ()
+        if self.save_cache is None or self.save_cache.key != key:
+            self.save_cache = utils.SaveFragment (key, self.get_save_record ())
+        return self.save_cache
 
     def make_primary (self):
         self.am_primary = True
@@ -129,6 +215,64 @@ class BaseThought (GObject.GObject):
     def okay (self):
         return self.all_okay
 
+    def content_changed (self):
+        ''' Call this whenever the thought's content (text, strokes, \
+            picture) changes.  It throws away the cached rendering'''
+        self.content_version += 1
+        self.drop_render_cache ()
+
+    def drop_render_cache (self):
+        render_caches.forget (self)
+        self.render_cache = None
+
+    def render_key (self, scale):
+        ''' Everything the cached rendering depends on, apart from the \
+            position of the thought.  Derived thoughts that draw more \
+            state than this must call content_changed when it changes'''
+        return (self.content_version, scale,
+                self.lr[0] - self.ul[0], self.lr[1] - self.ul[1],
+                self.am_selected, self.am_primary,
+                utils.color_to_string (self.background_color),
+                self.foreground_color and utils.color_to_string (self.foreground_color),
+                self.extended_buffer.get_char_count () > 0)
+
+    def draw_cached (self, context):
+        ''' Like draw, but renders the thought once into an offscreen \
+            surface and afterwards only composites that surface.  Panning \
+            and redrawing cost a blit, zooming re-renders once per scale'''
+        scale = math.hypot (*context.user_to_device_distance (1.0, 0.0))
+        if self.editing or self.creating or not self.ul or not self.lr or \
+           scale > RENDER_CACHE_MAX_SCALE:
+            self.drop_render_cache ()
+            self.draw (context)
+            return
+
+        key = self.render_key (scale)
+        x0 = self.ul[0] - RENDER_PADDING
+        y0 = self.ul[1] - RENDER_PADDING
+        if self.render_cache is None or self.render_cache[0] != key:
+            width = int (math.ceil ((self.lr[0] - x0 + RENDER_PADDING) * scale))
+            height = int (math.ceil ((self.lr[1] - y0 + RENDER_PADDING) * scale))
+            if width <= 0 or height <= 0:
+                return
+            surface = context.get_target ().create_similar (cairo.CONTENT_COLOR_ALPHA,
+                                                            width, height)
+            cache_context = cairo.Context (surface)
+            cache_context.scale (scale, scale)
+            cache_context.translate (-x0, -y0)
+            self.draw (cache_context)
+            self.render_cache = (key, surface, width * height * 4)
+        render_caches.touch (self, self.render_cache[2])
+
+        # Put the surface on whole device pixels, so it is copied as it
+        # is rather than resampled
+        x, y = context.user_to_device (x0, y0)
+        context.save ()
+        context.identity_matrix ()
+        context.set_source_surface (self.render_cache[1], round (x), round (y))
+        context.paint ()
+        context.restore ()
+
     def move_content_by (self, x, y):
         pass
 
@@ -191,10 +335,15 @@ class BaseThought (GObject.GObject):
     def load (self, node, tar):
         pass
 
-    def update_save (self):
+    def get_save_record (self):
         pass
 
-    def save (self, tar):
+    def get_save_files (self):
+        ''' (name, data, digest) for each file the thought keeps next to \
+            the manifest '''
+        return []
+
+    def rename_save_file (self, name, new_name):
         pass
 
     def copy_text (self, clip):
@@ -267,8 +416,8 @@ class ResizableThought (BaseThought):
 
     # Possible types of resizing - where the user selected to resize
 
-    def __init__ (self, coords, save, elem_type, undo, background_color, foreground_color):
-        super (ResizableThought, self).__init__(save, elem_type, undo, background_color, foreground_color)
+    def __init__ (self, coords, elem_type, undo, background_color, foreground_color):
+        super (ResizableThought, self).__init__(elem_type, undo, background_color, foreground_color)
         self.resizing = RESIZE_NONE
         self.button_down = False
         self.orig_size = None
@@ -430,7 +579,6 @@ class ResizableThought (BaseThought):
         self.ul = action.args[choose][0]
         self.width = action.args[choose][1]
         self.height = action.args[choose][2]
-        self.pic = self.orig_pic.scale_simple (int(self.width), int(self.height), GdkPixbuf.InterpType.HYPER)
         self.recalc_edges ()
         self.emit ("update_links")
         self.emit ("update_view")
@@ -19,18 +19,20 @@
 # Boston, MA  02110-1301  USA
 #
 
-import xml.dom.minidom as dom
-import xml.dom
 import gettext
 _ = gettext.gettext
+import sys
 import math
+import base64
 import logging
 import cairo
+from array import array
 
 from gi.repository import Gtk
 from gi.repository import Gdk
 
 from BaseThought import *
+from SpatialIndex import SpatialIndex
 import utils
 import UndoManager
 
@@ -40,25 +42,262 @@ STYLE_BEGIN=2
 ndraw =0
 SMOOTH = 5
 
+# Radius of the eraser, in canvas units
+ERASER_RADIUS = 4
+# How far a stroke reaches beyond its points (line width and caps)
+STROKE_PADDING = 2
+# For the eraser, long strokes index their segments in runs of this
+# many; shorter strokes are simply scanned
+SEGMENT_RUN = 32
+
+BLACK = "#000000000000"
+
+def segment_circle (x0, y0, x1, y1, cx, cy, radius_sqr):
+	''' Returns the parameters (t0, t1) along the segment from (x0, y0) \
+		to (x1, y1) where its line enters and leaves the circle, or None \
+		if the line misses it '''
+	dx = x1 - x0
+	dy = y1 - y0
+	fx = x0 - cx
+	fy = y0 - cy
+	a = dx*dx + dy*dy
+	if a == 0:
+		return None
+	b = 2 * (fx*dx + fy*dy)
+	c = fx*fx + fy*fy - radius_sqr
+	disc = b*b - 4*a*c
+	if disc < 0:
+		return None
+	root = math.sqrt (disc)
+	return ((-b - root) / (2*a), (-b + root) / (2*a))
+
+def simplify_polyline (xs, ys, tolerance):
+	''' Returns the indices of the points the Ramer-Douglas-Peucker \
+		algorithm keeps of the polyline, so that no dropped point is \
+		further than tolerance from the result '''
+	count = len (xs)
+	if count < 3:
+		return list (range (count))
+	keep = bytearray (count)
+	keep[0] = keep[count - 1] = 1
+	tolerance_sqr = tolerance * tolerance
+	pending = [(0, count - 1)]
+	while pending:
+		first, last = pending.pop ()
+		x0, y0 = xs[first], ys[first]
+		dx = xs[last] - x0
+		dy = ys[last] - y0
+		length_sqr = dx*dx + dy*dy
+		farthest = None
+		farthest_sqr = tolerance_sqr
+		for i in range (first + 1, last):
+			if length_sqr == 0:
+				dist_sqr = (xs[i] - x0)**2 + (ys[i] - y0)**2
+			else:
+				cross = dx * (ys[i] - y0) - dy * (xs[i] - x0)
+				dist_sqr = cross * cross / length_sqr
+			if dist_sqr > farthest_sqr:
+				farthest = i
+				farthest_sqr = dist_sqr
+		if farthest is not None:
+			keep[farthest] = 1
+			pending.append ((first, farthest))
+			pending.append ((farthest, last))
+	return [i for i in range (count) if keep[i]]
+
+def encode_points (xs, ys):
+	''' Packs the coordinates as little-endian doubles, x and y \
+		interleaved, and returns them base64 encoded '''
+	packed = array ('d', [0.0]) * (2 * len (xs))
+	packed[0::2] = xs
+	packed[1::2] = ys
+	if sys.byteorder != 'little':
+		packed.byteswap ()
+	if hasattr (packed, 'tobytes'):
+		data = packed.tobytes ()
+	else:
+		data = packed.tostring ()
+	return base64.b64encode (data).decode ('ascii')
+
+def decode_points (text):
+	''' Reverses encode_points, returning the xs and ys arrays '''
+	data = base64.b64decode (text.encode ('ascii'))
+	packed = array ('d')
+	if hasattr (packed, 'frombytes'):
+		packed.frombytes (data)
+	else:
+		packed.fromstring (data)
+	if sys.byteorder != 'little':
+		packed.byteswap ()
+	return packed[0::2], packed[1::2]
+
+class Stroke (object):
+	''' One continuous line of a drawing.  Its points are kept in \
+		arrays, together with their bounding box and, once drawn, the \
+		cairo path through them.  Finished strokes are never changed in \
+		place: the eraser replaces them with the pieces that are left '''
+
+	def __init__ (self, color=None, xs=None, ys=None):
+		self.color = color
+		self.xs = xs if xs is not None else array ('d')
+		self.ys = ys if ys is not None else array ('d')
+		self.path = None
+		self.bounds = None
+		self.segments = None
+		if len (self.xs):
+			self.bounds = (min (self.xs), min (self.ys), max (self.xs), max (self.ys))
+
+	def __len__ (self):
+		return len (self.xs)
+
+	def append (self, x, y):
+		self.xs.append (x)
+		self.ys.append (y)
+		if self.bounds is None:
+			self.bounds = (x, y, x, y)
+		else:
+			x0, y0, x1, y1 = self.bounds
+			self.bounds = (min (x0, x), min (y0, y), max (x1, x), max (y1, y))
+		self.path = None
+		self.segments = None
+
+	def translate (self, x, y):
+		self.xs = array ('d', [px + x for px in self.xs])
+		self.ys = array ('d', [py + y for py in self.ys])
+		if self.bounds is not None:
+			x0, y0, x1, y1 = self.bounds
+			self.bounds = (x0 + x, y0 + y, x1 + x, y1 + y)
+		self.path = None
+		self.segments = None
+
+	def intersects (self, x0, y0, x1, y1, padding=0):
+		if self.bounds is None:
+			return False
+		bx0, by0, bx1, by1 = self.bounds
+		return bx1 + padding >= x0 and bx0 - padding <= x1 and \
+			   by1 + padding >= y0 and by0 - padding <= y1
+
+	def draw (self, context):
+		if self.path is None:
+			xs, ys = self.xs, self.ys
+			context.move_to (xs[0], ys[0])
+			for i in range (1, len (xs)):
+				context.line_to (xs[i], ys[i])
+			self.path = context.copy_path ()
+		else:
+			context.append_path (self.path)
+		context.stroke ()
+
+	def simplify (self, tolerance):
+		''' Returns a copy of the stroke without the points that stay \
+			within tolerance of it, or None if there are none '''
+		keep = simplify_polyline (self.xs, self.ys, tolerance)
+		if len (keep) == len (self.xs):
+			return None
+		return Stroke (self.color, array ('d', [self.xs[i] for i in keep]),
+					   array ('d', [self.ys[i] for i in keep]))
+
+	def get_segments (self, x0, y0, x1, y1):
+		''' Returns the indices of the segments (segment i joins points \
+			i and i+1) whose bounds overlap the rectangle, in order '''
+		xs, ys = self.xs, self.ys
+		if len (xs) <= SEGMENT_RUN:
+			runs = [0]
+		else:
+			if self.segments is None:
+				# Index the bounds of each run of segments.  Taking min
+				# and max over array slices keeps building it cheap, as
+				# every piece the eraser leaves needs its own index.
+				self.segments = SpatialIndex ()
+				for run in range (0, (len (xs) - 2) // SEGMENT_RUN + 1):
+					start = run * SEGMENT_RUN
+					end = start + SEGMENT_RUN + 1
+					self.segments.insert (run, (min (xs[start:end]), min (ys[start:end]),
+												max (xs[start:end]), max (ys[start:end])))
+			runs = self.segments.query_rect (x0, y0, x1, y1)
+		found = []
+		for run in runs:
+			start = run * SEGMENT_RUN
+			for i in range (start, min (start + SEGMENT_RUN, len (xs) - 1)):
+				if max (xs[i], xs[i+1]) >= x0 and min (xs[i], xs[i+1]) <= x1 and \
+				   max (ys[i], ys[i+1]) >= y0 and min (ys[i], ys[i+1]) <= y1:
+					found.append (i)
+		return found
+
+	def erase (self, cx, cy, radius):
+		''' Returns the pieces of the stroke left outside the circle, or \
+			None if the circle doesn't touch it.  Segments are cut where \
+			they cross the circle.  Only the segments near the circle are \
+			examined; the runs of points between them are copied whole '''
+		xs, ys = self.xs, self.ys
+		radius_sqr = radius * radius
+		if len (xs) == 1:
+			if (xs[0] - cx)**2 + (ys[0] - cy)**2 < radius_sqr:
+				return []
+			return None
+		segments = self.get_segments (cx - radius, cy - radius, cx + radius, cy + radius)
+		if not segments:
+			return None
+
+		pieces = []
+		piece_xs, piece_ys = array ('d'), array ('d')
+		# The first point not yet copied to a piece or dropped
+		copied = 0
+		touched = False
+		for i in segments:
+			px, py, x, y = xs[i], ys[i], xs[i+1], ys[i+1]
+			a_inside = (px - cx)**2 + (py - cy)**2 < radius_sqr
+			b_inside = (x - cx)**2 + (y - cy)**2 < radius_sqr
+			if copied <= i:
+				# Points between the segments near the circle are all
+				# outside it
+				piece_xs.extend (xs[copied:i])
+				piece_ys.extend (ys[copied:i])
+				if not a_inside:
+					piece_xs.append (px)
+					piece_ys.append (py)
+			if a_inside or b_inside:
+				touched = True
+			if not (a_inside and b_inside):
+				hits = segment_circle (px, py, x, y, cx, cy, radius_sqr)
+				if hits is not None:
+					t0 = max (0.0, min (1.0, hits[0]))
+					t1 = max (0.0, min (1.0, hits[1]))
+					crosses = not a_inside and not b_inside and 0 < hits[0] < hits[1] < 1
+					if crosses or b_inside:
+						# Entering: the current piece ends on the circle
+						piece_xs.append (px + t0 * (x - px))
+						piece_ys.append (py + t0 * (y - py))
+						pieces.append ((piece_xs, piece_ys))
+						piece_xs, piece_ys = array ('d'), array ('d')
+						touched = True
+					if crosses or a_inside:
+						# Leaving: a new piece starts on the circle
+						piece_xs.append (px + t1 * (x - px))
+						piece_ys.append (py + t1 * (y - py))
+			if not b_inside:
+				piece_xs.append (x)
+				piece_ys.append (y)
+			copied = i + 2
+
+		if not touched:
+			return None
+		piece_xs.extend (xs[copied:])
+		piece_ys.extend (ys[copied:])
+		pieces.append ((piece_xs, piece_ys))
+		return [Stroke (self.color, piece[0], piece[1]) for piece in pieces if len (piece[0]) > 1]
+
 class DrawingThought(ResizableThought):
-	class DrawingPoint (object):
-		def __init__ (self, coords, style=STYLE_CONTINUE, color = Gdk.Color(0,0,0), width = 2):
-			self.x, self.y = coords
-			self.style = style
-			if color == None:
-				color = Gdk.Color(0,0,0)
-			self.color = color
-			self.width = 1
-		def move_by (self, x, y):
-			self.x += x
-			self.y += y
-
-	def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
+	def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color):
 		global ndraw
-		super (DrawingThought, self).__init__(coords, save, "drawing_thought", undo, background_color, foreground_color)
+		super (DrawingThought, self).__init__(coords, "drawing_thought", undo, background_color, foreground_color)
 		ndraw+=1
 		self.identity = thought_number
-		self.points = []
+		self.strokes = []
+		# The stroke being drawn, if any
+		self.stroke = None
+		# Canvas to screen scale, as of the last time we were drawn
+		self.device_scale = 1.0
 		self.text = _("Drawing #%d" % ndraw)
 		self.drawing = 0
 		self.all_okay = True
@@ -71,35 +310,45 @@ class DrawingThought(ResizableThought):
 		context.set_line_width (2)
 		context.set_line_join(cairo.LINE_JOIN_BEVEL)
 		context.set_line_cap(cairo.LINE_CAP_ROUND)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x, p.y)
-					r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
-					context.set_source_rgb (r, g, b)
-				elif p.style == STYLE_END:
-					context.line_to (p.x, p.y)
-					context.stroke()
-				else:
-					context.line_to (p.x, p.y)
+		r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
+		context.set_source_rgb (r, g, b)
+		context.new_path ()
+		self.device_scale = math.hypot (*context.user_to_device_distance (1.0, 0.0))
+		x0, y0, x1, y1 = context.clip_extents ()
+		for stroke in self.strokes:
+			if stroke.intersects (x0, y0, x1, y1, STROKE_PADDING):
+				stroke.draw (context)
 
 		context.set_line_width (cwidth)
-		context.stroke ()
 		return
 
 	def recalc_edges (self):
 		self.lr = (self.ul[0]+self.width, self.ul[1]+self.height)
 
+	def splice_strokes (self, edit):
+		''' Applies edit, an (index, removed, added) triple: the strokes \
+			removed, starting at index, are replaced by the ones added. \
+			Returns the edit that reverts it '''
+		index, removed, added = edit
+		self.strokes[index:index + len (removed)] = added
+		return (index, added, removed)
+
+	def apply_edits (self, edits):
+		''' Undoes (or redoes) edits, a list of edits as returned by \
+			splice_strokes.  Each one is replaced by the edit that \
+			reverts it, so the same list serves both ways '''
+		edits.reverse ()
+		for i, edit in enumerate (edits):
+			edits[i] = self.splice_strokes (edit)
+		self.content_changed ()
+
 	def undo_drawing (self, action, mode):
 		self.undo.block ()
 		if mode == UndoManager.UNDO:
 			choose = 1
-			for p in action.args[0]:
-				self.points.remove (p)
 		else:
 			choose = 2
-			for p in action.args[0]:
-				self.points.append (p)
+		self.apply_edits (action.args[0])
 
 		self.ul = action.args[choose][0]
 		self.width = action.args[choose][1]
@@ -119,16 +368,13 @@ class DrawingThought(ResizableThought):
 			if not event.state & Gdk.ModifierType.SHIFT_MASK:
 				self.drawing = 1
 			self.orig_size = (self.ul, self.width, self.height)
-			self.ins_points = []
-			self.del_points = []
+			self.stroke = None
+			self.edits = []
 			return True
 
 		return False
 
 	def process_button_release (self, event, transformed):
-		if len(self.points) > 0:
-			self.points[-1].style=STYLE_END
-
 		if self.orig_size:
 			if self.drawing == 0:
 				# correct sizes after creation
@@ -142,16 +388,28 @@ class DrawingThought(ResizableThought):
 					self.undo.add_undo (UndoManager.UndoAction (self, UNDO_RESIZE, \
 							self.undo_resize, self.orig_size, (self.ul, self.width, self.height)))
 
-			elif self.drawing == 1:
+			elif self.drawing == 1 and self.stroke is not None:
+				index = self.strokes.index (self.stroke)
+				edits = [(index, [self.stroke], [])]
+				# Replace the stroke by a simpler one.  The undo action
+				# keeps the original, so undoing and redoing it only
+				# repeats the simplification.
+				simple = None
+				if utils.stroke_tolerance > 0 and self.device_scale > 0:
+					simple = self.stroke.simplify (utils.stroke_tolerance / self.device_scale)
+				if simple is not None:
+					edits.append (self.splice_strokes ((index, [self.stroke], [simple])))
+					self.content_changed ()
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DRAW, \
-						self.undo_drawing, self.ins_points, self.orig_size, \
+						self.undo_drawing, edits, self.orig_size, \
 						(self.ul, self.width, self.height)))
 
 			elif self.drawing == 2:
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ERASE, \
-						self.undo_erase, self.ins_points))
+						self.undo_erase, self.edits))
 
 		self.drawing = 0
+		self.stroke = None
 		return ResizableThought.process_button_release(self, event, transformed)
 
 	def leave(self):
@@ -160,19 +418,7 @@ class DrawingThought(ResizableThought):
 
 	def undo_erase (self, action, mode):
 		self.undo.block ()
-		action.args[0].reverse ()
-		if mode == UndoManager.UNDO:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.remove (x[2])
-				else:
-					self.points.insert (x[1],x[2])
-		else:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.insert (x[1], x[2])
-				else:
-					self.points.remove (x[2])
+		self.apply_edits (action.args[0])
 		self.undo.unblock ()
 		self.emit ("update_view")
 
@@ -212,195 +458,92 @@ class DrawingThought(ResizableThought):
 				self.max_y = coords[1]+5
 			self.width = self.lr[0] - self.ul[0]
 			self.height = self.lr[1] - self.ul[1]
-			if len(self.points) == 0 or self.points[-1].style == STYLE_END:
-				p = self.DrawingPoint (coords, STYLE_BEGIN, self.foreground_color)
-			else:
-				p = self.DrawingPoint (coords, STYLE_CONTINUE)
-			self.points.append (p)
-			self.ins_points.append (p)
+			if self.stroke is None:
+				self.stroke = Stroke (self.foreground_color)
+				self.strokes.append (self.stroke)
+			self.stroke.append (coords[0], coords[1])
+			self.content_changed ()
 			return True
 
-		elif self.drawing == 2 and len (self.points) > 0:
-			out = self.points[0]
-			loc = []
-			handle = []
-			ins_point = -1
-
-			for x in self.points:
-				ins_point += 1
-				dist = (x.x - coords[0])**2 + (x.y - coords[1])**2
-
-				if dist < 16:
-					if x == self.points[0]:
-						out = None
-					loc.append ((ins_point, x, dist))
-				else:
-					if len(loc) != 0:
-						handle.append ((loc, out, x))
-						loc = []
-					elif x.style != STYLE_BEGIN:
-						x1 = x.x - out.x
-						y1 = x.y - out.y
-						d_rsqr = x1**2 + y1 **2
-						d = ((out.x-coords[0])*(x.y-coords[1]) - (x.x-coords[0])*(out.y-coords[1]))
-						det = (d_rsqr*16) - d**2
-						if det > 0:
-							xt = -99999
-							yt = -99999
-							xalt = -99999
-							yalt = -99999
-							if y1 < 0:
-								sgn = -1
-							else:
-								sgn = 1
-							xt = (((d*y1) + sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							xalt = (((d*y1) - sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							yt = (((-d*x1) + abs(y1)*math.sqrt(det)) / d_rsqr) + coords[1]
-							yalt = (((-d*x1) - abs(y1)*math.sqrt(det)) / d_rsqr) +coords[1]
-							x1_inside = (xt > x.x and xt < out.x) or (xt > out.x and xt < x.x)
-							x2_inside = (xalt > x.x and xalt < out.x) or (xalt > out.x and xalt < x.x)
-							y1_inside = (yt > x.y and yt < out.y) or (yt > out.y and yt < x.y)
-							y2_inside = (yalt > x.y and yalt < out.y) or (yalt > out.y and yalt < x.y)
-
-
-							if (x1_inside and x2_inside and y1_inside and y2_inside):
-							   	if abs (xalt - x.x) < abs (xt - x.x):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.x == out.x and y1_inside and y2_inside:
-							   	if abs (yalt - x.y) < abs (yt - x.y):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.y == out.y and x1_inside and x2_inside:
-								if abs (xalt - x.x) < abs (xt - x.x):
-								   	handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-								else:
-								   	handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-
-					out = x
-			if loc:
-				handle.append ((loc, out, None))
-			appends = []
-			dels = []
-			for l in handle:
-				inside = l[0]
-				prev = l[1]
-				next = l[2]
-				if not inside:
-					ins = l[3]
-					x1 = l[4]
-					x2 = l[5]
-					y1 = l[6]
-					y2 = l[7]
-					p1 = self.DrawingPoint ((x1,y1), STYLE_END)
-					p2 = self.DrawingPoint ((x2,y2), STYLE_BEGIN)
-					appends.append ((p1, ins))
-					appends.append ((p2, ins))
-				else:
-					first = inside[0][1]
-					last = inside[-1][1]
-					done_ins = 0
-					if last.style != STYLE_END:
-						end_dist = math.sqrt (inside[-1][2]) - 4
-						alpha = math.atan2 ((last.y-next.y), (last.x-next.x))
-						new_x = end_dist * math.cos(alpha) + last.x
-						new_y = end_dist * math.sin(alpha) + last.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_BEGIN)
-						appends.append ((p, inside[-1][0]))
-						done_ins = 1
-					if first.style != STYLE_BEGIN:
-						start_dist = math.sqrt (inside[0][2]) - 4
-						alpha = math.atan2 ((first.y-prev.y),(first.x-prev.x))
-						new_x = start_dist * math.cos (alpha) + first.x
-						new_y = start_dist * math.sin (alpha) + first.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_END)
-						appends.append ((p, inside[0][0]-done_ins))
-					for i in inside:
-						dels.append (i[1])
-			inserts = 0
-			for x in appends:
-				self.points.insert (x[1]+inserts, x[0])
-				self.ins_points.append ((0, x[1]+inserts, x[0]))
-				inserts+=1
-			for x in dels:
-				self.ins_points.append ((1, self.points.index (x), x))
-				self.points.remove (x)
+		elif self.drawing == 2:
+			# Only strokes whose bounds reach the eraser are looked at.
+			# Going backwards keeps the indices of the edits valid.
+			x, y = coords
+			r = ERASER_RADIUS
+			for i in range (len (self.strokes) - 1, -1, -1):
+				stroke = self.strokes[i]
+				if not stroke.intersects (x - r, y - r, x + r, y + r):
+					continue
+				pieces = stroke.erase (x, y, r)
+				if pieces is not None:
+					self.edits.append (self.splice_strokes ((i, [stroke], pieces)))
+					self.content_changed ()
 
 			return True
 
 		return False
 
 	def move_content_by(self, x, y):
-		map(lambda p : p.move_by(x,y), self.points)
+		for stroke in self.strokes:
+			stroke.translate (x, y)
 		ResizableThought.move_content_by(self, x, y)
 
-	def update_save (self):
-		next = self.element.firstChild
-		while next:
-			m = next.nextSibling
-			if next.nodeName == "point":
-				self.element.removeChild (next)
-				next.unlink ()
-			next = m		
-		text = self.extended_buffer.get_text ()
-		if text:
-			self.extended_buffer.update_save()
-		else:
-			try:
-				self.element.removeChild(self.extended_buffer.element)
-			except xml.dom.NotFoundErr:
-				pass
-		self.element.setAttribute ("ul-coords", str(self.ul))
-		self.element.setAttribute ("lr-coords", str(self.lr))
-		self.element.setAttribute ("identity", str(self.identity))
-		self.element.setAttribute ("background-color", self.background_color.to_string())
-		self.element.setAttribute ("foreground-color", self.foreground_color.to_string())
-		self.element.setAttribute ("min_x", str(self.min_x))
-		self.element.setAttribute ("min_y", str(self.min_y))
-		self.element.setAttribute ("max_x", str(self.max_x))
-		self.element.setAttribute ("max_y", str(self.max_y))
-
-		if self.am_selected:
-				self.element.setAttribute ("current_root", "true")
-		else:
-			try:
-				self.element.removeAttribute ("current_root")
-			except xml.dom.NotFoundErr:
-				pass
-		if self.am_primary:
-			self.element.setAttribute ("primary_root", "true");
-		else:
-			try:
-				self.element.removeAttribute ("primary_root")
-			except xml.dom.NotFoundErr:
-				pass
-		doc = self.element.ownerDocument
-		for p in self.points:
-			elem = doc.createElement ("point")
-			self.element.appendChild (elem)
-			elem.setAttribute ("coords", str((p.x,p.y)))
-			elem.setAttribute ("type", str(p.style))
-			elem.setAttribute ("color", p.color.to_string())
-		return
+	def get_save_key (self):
+		return ResizableThought.get_save_key (self) + (self.min_x, self.min_y, self.max_x, self.max_y,
+													   utils.compact_strokes)
+
+	def get_save_record (self):
+		attrs = [("ul-coords", str(self.ul)),
+		         ("lr-coords", str(self.lr)),
+		         ("identity", str(self.identity)),
+		         ("background-color", self.background_color.to_string()),
+		         ("foreground-color", self.foreground_color.to_string()),
+		         ("min_x", str(self.min_x)),
+		         ("min_y", str(self.min_y)),
+		         ("max_x", str(self.max_x)),
+		         ("max_y", str(self.max_y))]
+		attrs.extend (self.get_state_attributes ())
+		children = self.get_extended_records ()
+		for stroke in self.strokes:
+			if utils.compact_strokes:
+				color = BLACK
+				if stroke.color:
+					color = stroke.color.to_string()
+				children.append (("stroke", [("color", color),
+				                              ("points", encode_points (stroke.xs, stroke.ys))], []))
+				continue
+			last = len (stroke) - 1
+			for i in range (len (stroke)):
+				color = BLACK
+				if i == 0:
+					style = STYLE_BEGIN
+					if stroke.color:
+						color = stroke.color.to_string()
+				elif i == last:
+					style = STYLE_END
+				else:
+					style = STYLE_CONTINUE
+				children.append (("point", [("coords", str((stroke.xs[i],stroke.ys[i]))),
+				                             ("type", str(style)),
+				                             ("color", color)], []))
+		return (self.elem_type, attrs, children)
 
 	def load (self, node, tar):
-		tmp = node.getAttribute ("ul-coords")
+		tmp = node.get ("ul-coords")
 		self.ul = utils.parse_coords (tmp)
-		tmp = node.getAttribute ("lr-coords")
+		tmp = node.get ("lr-coords")
 		self.lr = utils.parse_coords (tmp)
-		self.identity = int (node.getAttribute ("identity"))
+		self.identity = int (node.get ("identity"))
 		try:
-			tmp = node.getAttribute ("background-color")
+			tmp = node.get ("background-color", "")
 			self.background_color = Gdk.Color.parse(tmp)[1]
-			tmp = node.getAttribute ("foreground-color")
+			tmp = node.get ("foreground-color", "")
 			self.foreground_color = Gdk.Color.parse(tmp)[1]
 		except ValueError:
 			pass
 
 		def get_min_max(node, name):
-			attr = node.getAttribute(name)
+			attr = node.get(name)
 			if attr == 'None':
 				return None
 			else:
@@ -414,37 +557,53 @@ class DrawingThought(ResizableThought):
 		self.width = self.lr[0] - self.ul[0]
 		self.height = self.lr[1] - self.ul[1]
 
-		self.am_selected = node.hasAttribute ("current_root")
-		self.am_primary = node.hasAttribute ("primary_root")
+		self.am_selected = "current_root" in node.attrib
+		self.am_primary = "primary_root" in node.attrib
 
-		for n in node.childNodes:
-			if n.nodeName == "Extended":
+		stroke = None
+		coords = iter (utils.parse_coords_list ([n.get ("coords") for n in node if n.tag == "point"]))
+		for n in node:
+			if n.tag == "Extended":
 				self.extended_buffer.load(n)
-			elif n.nodeName == "point":
-				style = int (n.getAttribute ("type"))
-				tmp = n.getAttribute ("coords")
-				c = utils.parse_coords (tmp)
+			elif n.tag == "point":
+				style = int (n.get ("type"))
+				c = next (coords)
+				if stroke is None or style == STYLE_BEGIN:
+					# Only the first point's color is kept for a stroke
+					col = None
+					try:
+						tmp = n.get ("color", "")
+						col = Gdk.Color.parse(tmp)[1]
+					except ValueError:
+						pass
+					stroke = Stroke (col)
+					self.strokes.append (stroke)
+				stroke.append (c[0], c[1])
+				if style == STYLE_END:
+					stroke = None
+			elif n.tag == "stroke":
 				col = None
 				try:
-					tmp = n.getAttribute ("color")
-					col = Gdk.Color.parse(tmp)[1]
+					col = Gdk.Color.parse(n.get ("color", ""))[1]
 				except ValueError:
 					pass
-				self.points.append (self.DrawingPoint (c, style, col))
+				xs, ys = decode_points (n.get ("points", ""))
+				if len (xs):
+					self.strokes.append (Stroke (col, xs, ys))
+				stroke = None
 			else:
-				print ("Unknown node type: "+str(n.nodeName))
+				print ("Unknown node type: "+str(n.tag))
 
 	def export (self, context, move_x, move_y):
 		utils.export_thought_outline (context, self.ul, self.lr, self.background_color, self.am_selected, self.am_primary, utils.STYLE_NORMAL,
 									  (move_x, move_y))
 		cwidth = context.get_line_width ()
 		context.set_line_width (1)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x+move_x, p.y+move_y)
-				else:
-					context.line_to (p.x+move_x,p.y+move_y)
+		for stroke in self.strokes:
+			xs, ys = stroke.xs, stroke.ys
+			context.move_to (xs[0]+move_x, ys[0]+move_y)
+			for i in range (1, len (xs)):
+				context.line_to (xs[i]+move_x, ys[i]+move_y)
 
 		context.set_line_width (cwidth)
 		r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
@@ -19,14 +19,15 @@
 # Boston, MA  02110-1301  USA
 #
 
-import xml.dom.minidom as dom
-import xml.dom
 import gettext
 _ = gettext.gettext
 import cairo
+import math
 import os
+import hashlib
 import logging
 import tempfile
+from collections import OrderedDict
 #import cStringIO
 
 from gi.repository import Gtk
@@ -41,13 +42,111 @@ import UndoManager
 from sugar3.activity.activity import get_activity_root
 from sugar3.graphics.objectchooser import ObjectChooser
 
+# How many pixels of decoded original pictures (and their halved
+# copies) image thoughts may keep around together.  About 64MB at 4
+# bytes each.
+DECODED_PIXEL_BUDGET = 16 * 1024 * 1024
+
+class DecodedImages:
+    ''' Keeps track of which image thoughts hold their decoded original \
+        picture.  When they hold more than the budget, the originals of \
+        the thoughts used least recently are dropped.  The thoughts keep \
+        the picture scaled to their size, which is what gets drawn, and \
+        only decode the original again to rescale it.  While a draw pass \
+        is running, the thoughts it used are never dropped'''
+
+    def __init__ (self, budget = DECODED_PIXEL_BUDGET):
+        self.budget = budget
+        # thought -> (pixels, pass it was last used in)
+        self.entries = OrderedDict ()
+        self.pixels = 0
+        self.current_pass = 0
+        # Whether a draw pass is running.  Outside of one (loading,
+        # exporting) only the thought being used is kept.
+        self.in_pass = False
+
+    def begin_pass (self):
+        self.current_pass += 1
+        self.in_pass = True
+
+    def end_pass (self):
+        self.in_pass = False
+
+    def touch (self, thought):
+        ''' Records that thought was just used, along with its current \
+            number of decoded pixels '''
+        old = self.entries.pop (thought, None)
+        if old:
+            self.pixels -= old[0]
+        pixels = thought.get_decoded_pixels ()
+        if not pixels:
+            return
+        self.entries[thought] = (pixels, self.current_pass)
+        self.pixels += pixels
+        while self.pixels > self.budget:
+            oldest = next (iter (self.entries))
+            pixels, used_in = self.entries[oldest]
+            if oldest is thought or (self.in_pass and used_in == self.current_pass):
+                break
+            del self.entries[oldest]
+            self.pixels -= pixels
+            oldest.drop_original ()
+
+    def forget (self, thought):
+        old = self.entries.pop (thought, None)
+        if old:
+            self.pixels -= old[0]
+
+decoded_images = DecodedImages ()
+
+class MipMap:
+    ''' A picture together with copies of it halved in size again and \
+        again.  The smaller copies are only made when first asked for, \
+        each one from the level above it '''
+
+    def __init__ (self, pixbuf):
+        self.levels = [pixbuf]
+
+    def level (self, n):
+        while len (self.levels) <= n:
+            last = self.levels[-1]
+            width, height = last.get_width (), last.get_height ()
+            if width == 1 and height == 1:
+                return last
+            self.levels.append (last.scale_simple (max (1, width // 2), max (1, height // 2),
+                                                   GdkPixbuf.InterpType.BILINEAR))
+        return self.levels[n]
+
+    def level_for (self, reduction):
+        ''' Returns the smallest level that is still at least reduction \
+            times the size of the picture (reduction is at most 1) '''
+        if reduction >= 1.0 or reduction <= 0.0:
+            return self.levels[0]
+        return self.level (int (math.floor (math.log (1.0 / reduction, 2))))
+
+    def get_pixels (self):
+        pixels = 0
+        for level in self.levels:
+            pixels += level.get_width () * level.get_height ()
+        return pixels
+
 class ImageThought (ResizableThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
-        super (ImageThought, self).__init__(coords, save, "image_thought", undo, background_color, foreground_color)
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color):
+        super (ImageThought, self).__init__(coords, "image_thought", undo, background_color, foreground_color)
 
         self.identity = thought_number
         self.pic = None
         self.orig_pic = None
+        # Halved copies of the two above.  Rescaling the thought starts
+        # from the level of orig_pic closest to the new size, and drawing
+        # zoomed out paints a level of pic instead of pic itself.
+        self.pic_levels = None
+        self.orig_levels = None
+        # The image as PNG, as it was read from the map or converted from
+        # the journal, and its hash.  Saving stores these bytes as they
+        # are.
+        self.data = None
+        self.digest = None
         self.pic_location = coords
         self.button_press = False
         self.all_okay = True
@@ -73,7 +172,13 @@ class ImageThought (ResizableThought):
             if jobject and jobject.file_path:
                 logging.debug("journal_open_image: fname=%s" % jobject.file_path)
                 try:
-                    self.orig_pic = GdkPixbuf.Pixbuf.new_from_file(jobject.file_path)
+                    f = open(jobject.file_path, 'rb')
+                    try:
+                        # Converted once here, so the map only ever
+                        # stores PNG
+                        self.set_data(utils.png_from_data(f.read()))
+                    finally:
+                        f.close()
                     self.filename = os.path.join('images', os.path.basename(jobject.file_path))
                 except Exception as e:
                     logging.error("journal_open_image: %s" % e)
@@ -92,25 +197,35 @@ class ImageThought (ResizableThought):
 
     def draw (self, context):
         ResizableThought.draw(self, context)
+        self.ensure_decoded ()
         if self.pic:
-            context.set_source_pixbuf (self.pic, self.pic_location[0], self.pic_location[1])
-            context.rectangle (self.pic_location[0], self.pic_location[1], self.width, self.height)
+            scale = math.hypot (*context.user_to_device_distance (1.0, 0.0))
+            pic = self.pic_levels.level_for (scale)
+            context.save ()
+            context.translate (self.pic_location[0], self.pic_location[1])
+            if pic is not self.pic:
+                context.scale (float (self.pic.get_width ()) / pic.get_width (),
+                               float (self.pic.get_height ()) / pic.get_height ())
+            context.set_source_pixbuf (pic, 0, 0)
+            context.rectangle (0, 0, pic.get_width (), pic.get_height ())
             context.fill ()
+            context.restore ()
         context.set_source_rgb (0,0,0)
 
     def export (self, context, move_x, move_y):
         utils.export_thought_outline (context, self.ul, self.lr, self.background_color, self.am_selected, self.am_primary, utils.STYLE_NORMAL,
                                       (move_x, move_y))
+        self.ensure_decoded ()
         if self.pic:
-            raw_pixels = self.pic.get_pixels_array()
+            width, height = self.pic.get_width(), self.pic.get_height()
             if hasattr(context, "set_source_pixbuf"):
                 context.set_source_pixbuf (self.pic, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
             elif hasattr(context, "set_source_surface"):
-                pixel_array = utils.pixbuf_to_cairo (raw_pixels)
-                image_surface = cairo.ImageSurface.create_for_data(pixel_array, cairo.FORMAT_ARGB32, len(raw_pixels[0]), len(raw_pixels), -1)
+                pixel_array = utils.pixbuf_to_cairo (self.pic)
+                image_surface = cairo.ImageSurface.create_for_data(pixel_array, cairo.FORMAT_ARGB32, width, height, width * 4)
                 context.set_source_surface (image_surface, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
-                
-            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, len(raw_pixels[0]), len(raw_pixels))
+
+            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, width, height)
             context.fill ()
         context.set_source_rgb (0,0,0)
 
@@ -123,10 +238,19 @@ class ImageThought (ResizableThought):
         pic_w = max(MIN_SIZE, self.width - margin[0] - margin[2])
         pic_h = max(MIN_SIZE, self.height - margin[1] - margin[3])
 
-        if self.orig_pic and (force or not self.pic or self.pic.get_width() != pic_w
-                or self.pic.get_height() != pic_h):
-                        self.pic = self.orig_pic.scale_simple(int(pic_w),
+        # Until the picture is first needed (see ensure_decoded) the
+        # edges come from the saved size alone
+        if self.data is not None and (force or self.pic and (self.pic.get_width() != pic_w
+                or self.pic.get_height() != pic_h)):
+                        self.ensure_original()
+                        # The level has to be large enough along both axes
+                        reduction = max(float(pic_w) / self.orig_pic.get_width(),
+                                        float(pic_h) / self.orig_pic.get_height())
+                        source = self.orig_levels.level_for(reduction)
+                        self.pic = source.scale_simple(int(pic_w),
                                   int(pic_h), scale)
+                        self.pic_levels = MipMap(self.pic)
+                        self.content_changed ()
 
 
     def process_button_down (self, event, coords):
@@ -144,6 +268,7 @@ class ImageThought (ResizableThought):
                     self.width = max(MIN_SIZE, self.width)
                     self.height = max(MIN_SIZE, self.height)
                 else:
+                    self.ensure_original()
                     self.width = self.orig_pic.get_width()
                     self.height = self.orig_pic.get_height()
                 self.creating = False
@@ -164,69 +289,102 @@ class ImageThought (ResizableThought):
 
         return False
 
-    def update_save (self):
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute ("ul-coords", str(self.ul))
-        self.element.setAttribute ("lr-coords", str(self.lr))
-        self.element.setAttribute ("identity", str(self.identity))
-        self.element.setAttribute ("background-color", self.background_color.to_string())
-        self.element.setAttribute ("file", str(self.filename))
-        self.element.setAttribute ("image_width", str(self.width))
-        self.element.setAttribute ("image_height", str(self.height))
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-            except xml.dom.NotFoundErr:
-                pass
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("primary_root")
-            except xml.dom.NotFoundErr:
-                pass
-
-    def save (self, tar):
-        if not [i for i in tar.getnames() if i == self.filename]:
-            tar.write(self.filename, self.orig_pic)
+    def get_save_key (self):
+        return ResizableThought.get_save_key (self) + (self.filename, self.width, self.height)
+
+    def get_save_record (self):
+        attrs = [("ul-coords", str(self.ul)),
+                 ("lr-coords", str(self.lr)),
+                 ("identity", str(self.identity)),
+                 ("background-color", self.background_color.to_string()),
+                 ("file", str(self.filename)),
+                 ("image_width", str(self.width)),
+                 ("image_height", str(self.height))]
+        attrs.extend (self.get_state_attributes ())
+        return (self.elem_type, attrs, self.get_extended_records ())
+
+    def set_data (self, data, decode=True):
+        ''' Sets the encoded picture.  Unless decode is given, it is only \
+            decoded once the thought is drawn or exported '''
+        self.data = data
+        self.digest = hashlib.sha1(data).hexdigest()
+        self.drop_decoded ()
+        if decode:
+            self.ensure_decoded ()
+
+    def ensure_decoded (self):
+        ''' Makes sure the picture scaled to the thought is there '''
+        if self.pic is None and self.data is not None:
+            self.ensure_original ()
+            if self.ul:
+                self.recalc_edges (True)
+
+    def ensure_original (self):
+        if self.orig_pic is None and self.data is not None:
+            self.orig_pic = utils.pixbuf_from_data(self.data)
+            self.orig_levels = MipMap(self.orig_pic)
+        decoded_images.touch (self)
+
+    def drop_original (self):
+        self.orig_pic = self.orig_levels = None
+
+    def drop_decoded (self):
+        decoded_images.forget (self)
+        self.drop_original ()
+        self.pic = self.pic_levels = None
+
+    def get_decoded_pixels (self):
+        if self.orig_levels:
+            return self.orig_levels.get_pixels ()
+        return 0
+
+    def get_save_files (self):
+        if self.data is None:
+            return []
+        # Maps saved by development versions may hold other formats
+        data = utils.png_from_data (self.data)
+        if data is not self.data:
+            self.data = data
+            self.digest = hashlib.sha1(data).hexdigest()
+        return [(self.filename, self.data, self.digest)]
+
+    def rename_save_file (self, name, new_name):
+        if self.filename == name:
+            self.filename = new_name
 
     def load (self, node, tar):
-        tmp = node.getAttribute ("ul-coords")
+        tmp = node.get ("ul-coords")
         self.ul = utils.parse_coords (tmp)
-        tmp = node.getAttribute ("lr-coords")
+        tmp = node.get ("lr-coords")
         self.lr = utils.parse_coords (tmp)
         self.filename = os.path.join('images', 
-                os.path.basename(node.getAttribute ("file")))
-        self.identity = int (node.getAttribute ("identity"))
+                os.path.basename(node.get ("file", "")))
+        self.identity = int (node.get ("identity"))
         try:
-            tmp = node.getAttribute ("background-color")
+            tmp = node.get ("background-color", "")
             self.background_color = Gdk.Color.parse(tmp)
 
         except ValueError:
             pass
 
-        self.width = float(node.getAttribute ("image_width"))
-        self.height = float(node.getAttribute ("image_height"))
-        self.am_selected = node.hasAttribute ("current_root")
-        self.am_primary = node.hasAttribute ("primary_root")
+        self.width = float(node.get ("image_width"))
+        self.height = float(node.get ("image_height"))
+        self.am_selected = "current_root" in node.attrib
+        self.am_primary = "primary_root" in node.attrib
 
-        for n in node.childNodes:
-            if n.nodeName == "Extended":
+        for n in node:
+            if n.tag == "Extended":
                 self.extended_buffer.load(n)
             else:
-                print ("Unknown: "+n.nodeName)
+                print ("Unknown: "+n.tag)
         margin = utils.margin_required (utils.STYLE_NORMAL)
         self.pic_location = (self.ul[0]+margin[0], self.ul[1]+margin[1])
-        self.orig_pic = tar.read_pixbuf(self.filename)
+        if tar.exists(self.filename):
+            # A view of the memory mapped map where possible, so the
+            # picture isn't copied into memory just to be kept around
+            self.set_data(tar.read_buffer(self.filename), decode=False)
+        else:
+            logging.error("load: image %s is missing from the map" % self.filename)
         self.lr = (self.pic_location[0]+self.width+margin[2], self.pic_location[1]+self.height+margin[3])
         self.recalc_edges()
     
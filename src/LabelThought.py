@@ -22,7 +22,6 @@
 #
 
 import utils
-import xml.dom
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -32,8 +31,8 @@ from BaseThought import *
 from TextThought import TextThought
 
 class LabelThought (TextThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, name="label_thought"):
-        super (LabelThought, self).__init__(coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, name)
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color, name="label_thought"):
+        super (LabelThought, self).__init__(coords, pango_context, thought_number, undo, loading, background_color, foreground_color, name)
         self.edge = True
 
     def can_be_parent(self):
@@ -72,116 +71,79 @@ class LabelThought (TextThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        if self.text_element.parentNode is not None:
-            self.text_element.replaceWholeText (self.text)
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute ("cursor", str(self.index))
-        self.element.setAttribute ("ul-coords", str(self.ul))
-        self.element.setAttribute ("lr-coords", str(self.lr))
-        self.element.setAttribute ("identity", str(self.identity))
-        self.element.setAttribute ("background-color", utils.color_to_string(self.background_color))
-        self.element.setAttribute ("foreground-color", utils.color_to_string(self.foreground_color))
-        self.element.setAttribute ("edge", str(self.edge))
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-            except xml.dom.NotFoundErr:
-                pass
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true");
-        else:
-            try:
-                self.element.removeAttribute ("primary_root")
-            except xml.dom.NotFoundErr:
-                pass
-        doc = self.element.ownerDocument
+    def get_save_key (self):
+        return TextThought.get_save_key (self) + (self.edge,)
+
+    def get_save_record (self):
+        attrs = [("cursor", str(self.index)),
+                 ("ul-coords", str(self.ul)),
+                 ("lr-coords", str(self.lr)),
+                 ("identity", str(self.identity)),
+                 ("background-color", utils.color_to_string(self.background_color)),
+                 ("foreground-color", utils.color_to_string(self.foreground_color)),
+                 ("edge", str(self.edge))]
+        attrs.extend (self.get_state_attributes ())
+        children = self.get_extended_records ()
+        if self.text:
+            children.append (self.text)
         it = self.attributes.get_iterator()
         while (1):
             r = it.range()
             for x in it.get_attrs():
                 if x.type == Pango.Weight and x.value == Pango.Weight.BOLD:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "bold")
+                    children.append (("attribute", [("start", str(r[0])), ("end", str(r[1])),
+                                                    ("type", "bold")], []))
                 elif x.type == Pango.Style and x.value == Pango.Style.ITALIC:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "italics")
+                    children.append (("attribute", [("start", str(r[0])), ("end", str(r[1])),
+                                                    ("type", "italics")], []))
                 elif x.type == Pango.Underline and x.value == Pango.Underline.SINGLE:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "underline")
+                    children.append (("attribute", [("start", str(r[0])), ("end", str(r[1])),
+                                                    ("type", "underline")], []))
                 elif x.type == Pango.AttrFontDesc:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "font")
-                    elem.setAttribute("value", x.desc.to_string ())
+                    children.append (("attribute", [("start", str(r[0])), ("end", str(r[1])),
+                                                    ("type", "font"),
+                                                    ("value", x.desc.to_string ())], []))
             if not it.next():
                 break
+        return (self.elem_type, attrs, children)
 
     def load (self, node, tar):
-        self.index = int (node.getAttribute ("cursor"))
+        self.index = int (node.get ("cursor"))
         self.end_index = self.index
-        tmp = node.getAttribute ("ul-coords")
+        tmp = node.get ("ul-coords")
         self.ul = utils.parse_coords (tmp)
-        tmp = node.getAttribute ("lr-coords")
+        tmp = node.get ("lr-coords")
         self.lr = utils.parse_coords (tmp)
 
         self.width = self.lr[0] - self.ul[0]
         self.height = self.lr[1] - self.ul[1]
 
-        self.identity = int (node.getAttribute ("identity"))
+        self.identity = int (node.get ("identity"))
         try:
-            tmp = node.getAttribute ("background-color")
+            tmp = node.get ("background-color", "")
             self.background_color = Gdk.Color.parse(tmp)
-            tmp = node.getAttribute ("foreground-color")
+            tmp = node.get ("foreground-color", "")
             self.foreground_color = Gdk.Color.parse(tmp)
         except ValueError:
             pass
 
-        self.am_selected = node.hasAttribute ("current_root")
-        self.am_primary = node.hasAttribute ("primary_root")
+        self.am_selected = "current_root" in node.attrib
+        self.am_primary = "primary_root" in node.attrib
         
-        if node.getAttribute ("edge") == "True":
+        if node.get ("edge") == "True":
             self.edge = True
         else:
             self.edge = False
 
-        for n in node.childNodes:
-            if n.nodeType == n.TEXT_NODE:
-                self.text = n.data
-            elif n.nodeName == "Extended":
+        if node.text:
+            self.text = node.text
+        for n in node:
+            if n.tag == "Extended":
                 self.extended_buffer.load(n)
-            elif n.nodeName == "attribute":
-                attrType = n.getAttribute("type")
-                start = int(n.getAttribute("start"))
-                end = int(n.getAttribute("end"))
+            elif n.tag == "attribute":
+                attrType = n.get("type")
+                start = int(n.get("start"))
+                end = int(n.get("end"))
 
                 attr = None  ## FIXME: REMOVE THIS
 
@@ -193,7 +155,7 @@ class LabelThought (TextThought):
                 elif attrType == "underline":
                     attr = Pango.Underline(Pango.Underline.SINGLE)
                 elif attrType == "font":
-                    #font_name = str(n.getAttribute("value"))
+                    #font_name = str(n.get("value"))
                     #pango_font = Pango.FontDescription (font_name)
                     #attr = pango.AttrFontDesc (pango_font, start, end)
                     pass
@@ -201,7 +163,9 @@ class LabelThought (TextThought):
                 if attr:  ## FIXME: REMOVE THIS
                     self.attributes.change(attr)
             else:
-                print ("Unknown: "+n.nodeName)
+                print ("Unknown: "+n.tag)
+            if n.tail:
+                self.text = n.tail
         self.rebuild_byte_table ()
         self.recalc_edges()
 
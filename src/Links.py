@@ -43,18 +43,20 @@ class Link (GObject.GObject):
                          popup_requested     = (GObject.SIGNAL_RUN_FIRST,
                                                  GObject.TYPE_NONE,
                                                  (GObject.TYPE_PYOBJECT, GObject.TYPE_INT)))
-    def __init__ (self, save, parent = None, child = None, start_coords = None, end_coords = None, strength = 2):
+    def __init__ (self, parent = None, child = None, start_coords = None, end_coords = None, strength = 2):
         super (Link, self).__init__()
         self.parent = parent
         self.child = child
         self.end = end_coords
         self.start = start_coords
         self.strength = strength
-        self.element = save.createElement ("link")
         self.selected = False
         self.color = utils.gtk_to_cairo_color(Gdk.color_parse('black'))
         self.model_iter = None
         self.text = None
+        self.bounds = None
+        self.bounds_key = None
+        self.save_cache = None
 
         if not self.start and parent and parent.lr:
             self.start = (parent.ul[0]-((parent.ul[0]-parent.lr[0]) / 2.), \
@@ -63,8 +65,27 @@ class Link (GObject.GObject):
         if parent and child:
             self.find_ends ()
 
-    def get_save_element (self):
-        return self.element
+    def get_controls (self):
+        ''' The two inner control points of the curve drawn for the link '''
+        dx = self.end[0] - self.start[0]
+        return (self.start[0] + dx / 2.0, self.start[1]), (self.end[0] - dx / 2.0, self.end[1])
+
+    def get_bounds (self):
+        ''' The area covered by the link when drawn (including the \
+            control points when curves are used), or None if the link \
+            has no ends yet.  The result is cached until the ends move'''
+        if not self.start or not self.end:
+            return None
+        key = (self.start, self.end, self.strength, utils.use_bezier_curves)
+        if key != self.bounds_key:
+            points = [self.start, self.end]
+            if utils.use_bezier_curves:
+                points.extend (self.get_controls ())
+            pad = self.strength / 2.0 + 1
+            self.bounds = (min ([p[0] for p in points]) - pad, min ([p[1] for p in points]) - pad,
+                           max ([p[0] for p in points]) + pad, max ([p[1] for p in points]) + pad)
+            self.bounds_key = key
+        return self.bounds
 
     def includes (self, coords):
         # TODO: Change this to make link selection work.  Also needs
@@ -128,10 +149,8 @@ class Link (GObject.GObject):
         context.move_to (self.start[0], self.start[1])
 
         if utils.use_bezier_curves:
-            dx = self.end[0] - self.start[0]
-            x2 = self.start[0] + dx / 2.0
-            x3 = self.end[0] - dx / 2.0
-            context.curve_to(x2, self.start[1], x3, self.end[1], self.end[0], self.end[1])
+            (x2, y2), (x3, y3) = self.get_controls ()
+            context.curve_to(x2, y2, x3, y3, self.end[0], self.end[1])
         else:
             context.line_to (self.end[0], self.end[1])
 
@@ -159,10 +178,8 @@ class Link (GObject.GObject):
         context.move_to (self.start[0]+move_x, self.start[1]+move_y)
 
         if utils.use_bezier_curves:
-            dx = self.end[0] - self.start[0]
-            x2 = self.start[0] + dx / 2.0
-            x3 = self.end[0] - dx / 2.0
-            context.curve_to(x2+move_x, self.start[1]+move_y, x3+move_x, self.end[1]+move_y, self.end[0]+move_x, self.end[1]+move_y)
+            (x2, y2), (x3, y3) = self.get_controls ()
+            context.curve_to(x2+move_x, y2+move_y, x3+move_x, y3+move_y, self.end[0]+move_x, self.end[1]+move_y)
         else:
             context.line_to (self.end[0]+move_x, self.end[1]+move_y)
 
@@ -177,46 +194,59 @@ class Link (GObject.GObject):
         if self.parent and self.child:
             self.find_ends ()
 
-    def update_save (self):
-        self.element.setAttribute ("start", str(self.start))
-        self.element.setAttribute ("end", str(self.end))
-        self.element.setAttribute ("strength", str(self.strength))
-        self.element.setAttribute ("color", str(self.color))
+    def get_save_key (self):
+        return (self.start, self.end, self.strength, self.color,
+                self.parent and self.parent.identity,
+                self.child and self.child.identity)
+
+    def get_save_fragment (self):
+        ''' The link as a utils.SaveFragment, made anew only when it changed '''
+        key = self.get_save_key ()
+        if self.save_cache is None or self.save_cache.key != key:
+            self.save_cache = utils.SaveFragment (key, self.get_save_record ())
+        return self.save_cache
+
+    def get_save_record (self):
+        attrs = [("start", str(self.start)),
+                 ("end", str(self.end)),
+                 ("strength", str(self.strength)),
+                 ("color", str(self.color))]
         if self.child:
-            self.element.setAttribute ("child", str(self.child.identity))
+            attrs.append (("child", str(self.child.identity)))
         else:
-            self.element.setAttribute ("child", "None")
+            attrs.append (("child", "None"))
         if self.parent:
-            self.element.setAttribute ("parent", str(self.parent.identity))
+            attrs.append (("parent", str(self.parent.identity)))
         else:
-            self.element.setAttribute ("parent", "None")
+            attrs.append (("parent", "None"))
+        return ("link", attrs, [])
 
     def load (self, node):
         self.parent_number = self.child_number = -1
-        tmp = node.getAttribute ("end")
+        tmp = node.get ("end")
         if not tmp:
             print ("No tmp found")
             return
         self.end = utils.parse_coords (tmp)
-        tmp = node.getAttribute ("start")
+        tmp = node.get ("start")
         if not tmp:
             print ("No start found")
             return
         self.start = utils.parse_coords (tmp)
-        self.strength = int(node.getAttribute ("strength"))
+        self.strength = int(node.get ("strength"))
         try:
-            colors = node.getAttribute ("color").split()
+            colors = node.get ("color").split()
             self.color = (float(colors[0].strip('(,)')), float(colors[1].strip('(,)')), float(colors[2].strip('(,)')))
         except:
             pass
-        if node.hasAttribute ("parent"):
-            tmp = node.getAttribute ("parent")
+        if "parent" in node.attrib:
+            tmp = node.get ("parent")
             if tmp == "None":
                 self.parent_number = -1
             else:
                 self.parent_number = int (tmp)
-        if node.hasAttribute ("child"):
-            tmp = node.getAttribute ("child")
+        if "child" in node.attrib:
+            tmp = node.get ("child")
             if tmp == "None":
                 self.child_number = -1
             else:
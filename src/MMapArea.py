@@ -20,6 +20,7 @@
 # Boston, MA  02110-1301  USA
 #
 
+import os
 import math
 import time
 import string
@@ -27,9 +28,10 @@ import gettext
 import copy
 import cairo
 import logging
+import itertools
+from collections import OrderedDict
 _ = gettext.gettext
 
-import xml.dom.minidom as dom
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -44,7 +46,8 @@ import DrawingThought
 import ResourceThought
 import UndoManager
 import utils
-from BaseThought import BaseThought
+from SpatialIndex import SpatialIndex
+from BaseThought import BaseThought, render_caches
 from Links import Link
 
 RAD_UP = (- math.pi / 2.)
@@ -119,6 +122,17 @@ class MMapArea (Gtk.DrawingArea):
 
         self.thoughts = []
         self.links = []
+        self.thought_index = SpatialIndex ()
+        self.link_index = SpatialIndex ()
+        # The curve setting the link bounds in link_index were taken with
+        self.index_curves = utils.use_bezier_curves
+        # thought -> links using it, and (parent, child) -> link
+        self.thought_links = {}
+        self.link_pairs = {}
+        self.hover = None
+        self.bbox_hits = set ()
+        self.damaged = None
+        self.damage_handler = None
         self.selected = []
         self.num_selected = 0
         self.primary = None
@@ -134,9 +148,6 @@ class MMapArea (Gtk.DrawingArea):
 
         self.nthoughts = 0
 
-        impl = dom.getDOMImplementation()
-        self.save = impl.createDocument("http://www.donscorgie.blueyonder.co.uk/labns", "MMap", None)
-        self.element = self.save.documentElement
         self.im_context = Gtk.IMMulticontext ()
 
         self.mode = MODE_NULL
@@ -167,6 +178,9 @@ class MMapArea (Gtk.DrawingArea):
         self.current_root = []
         self.rotation = 0
         self.text_attributes = {}
+        # What the last call to draw painted and skipped.  Handy when profiling
+        self.draw_stats = {"thoughts_drawn": 0, "thoughts_culled": 0,
+                           "links_drawn": 0, "links_culled": 0}
 
         self.set_events (Gdk.EventMask.KEY_PRESS_MASK |
                          Gdk.EventMask.KEY_RELEASE_MASK |
@@ -204,6 +218,14 @@ class MMapArea (Gtk.DrawingArea):
         utils.selected_colors["fg"] = utils.gtk_to_cairo_color(c.get_color(Gtk.StateFlags.SELECTED))  ##utils.gtk_to_cairo_color(style.fg[gtk.STATE_SELECTED])
         utils.selected_colors["fill"] = utils.gtk_to_cairo_color(c.get_background_color(Gtk.StateFlags.SELECTED)) ##utils.gtk_to_cairo_color(style.base[gtk.STATE_SELECTED])
 
+    def get_selected (self):
+        return self._selected
+
+    def set_selected (self, items):
+        self._selected = Selection (items)
+
+    selected = property (get_selected, set_selected)
+
     def set_text_attributes(self, text_attributes):
         return
     '''
@@ -261,6 +283,7 @@ class MMapArea (Gtk.DrawingArea):
 
         elif event.button == 1 and self.mode == MODE_NULL:
             self.bbox_origin = coords
+            self.bbox_hits = set (t for t in self.selected if t in self.thought_index)
             self.is_bbox_selecting = True
 
     def undo_move (self, action, mode):
@@ -289,6 +312,7 @@ class MMapArea (Gtk.DrawingArea):
 
         if self.is_bbox_selecting:
             self.is_bbox_selecting = False
+            self.bbox_hits = set ()
             self.invalidate ()
             try:
                 if abs(self.bbox_origin[0] - coords[0]) > 2.0:
@@ -405,8 +429,12 @@ class MMapArea (Gtk.DrawingArea):
         coords = self.transform_coords (event.get_coords()[0], event.get_coords()[1])
 
         if event.state & Gdk.ModifierType.BUTTON1_MASK and self.is_bbox_selecting:
+            # Repaint where the box was and where it is now
+            for corner in (getattr (self, "bbox_current", None), coords):
+                if corner:
+                    self.damage ((min (self.bbox_origin[0], corner[0]), min (self.bbox_origin[1], corner[1]),
+                                  max (self.bbox_origin[0], corner[0]), max (self.bbox_origin[1], corner[1])))
             self.bbox_current = coords
-            self.invalidate()
 
             ul = [ self.bbox_origin[0], self.bbox_origin[1] ]
             lr = [ coords[0], coords[1] ]
@@ -425,25 +453,35 @@ class MMapArea (Gtk.DrawingArea):
                 lr[0] = coords[0]
                 lr[1] = self.bbox_origin[1]
 
-            # FIXME: O(n) runtime is bad
-            for t in self.thoughts:
-                if t.lr[0] > ul[0] and t.ul[1] < lr[1] and t.ul[0] < lr[0] and t.lr[1] > ul[1] :
-                    if t not in self.selected:
-                        self.select_thought(t, Gdk.ModifierType.SHIFT_MASK)
-                else:
-                    if t in self.selected:
-                        t.unselect()
-                        self.selected.remove(t)
+            # Only thoughts entering or leaving the box since the last
+            # motion event change their selection state
+            hits = [t for t in self.thought_index.query_rect (ul[0], ul[1], lr[0], lr[1])
+                    if t.ul and t.lr and t.lr[0] > ul[0] and t.ul[1] < lr[1] and
+                       t.ul[0] < lr[0] and t.lr[1] > ul[1]]
+            inside = set (hits)
+            leaving = self.bbox_hits - inside
+            entering = [t for t in hits if t not in self.bbox_hits]
+            if leaving:
+                for t in leaving:
+                    t.unselect()
+                    self.damage (self.thought_index.get_bounds (t))
+                self.selected = [t for t in self.selected if t not in leaving]
+            self.select_thoughts (entering)
+            for t in entering:
+                self.damage (self.thought_index.get_bounds (t))
+            self.bbox_hits = inside
             return True
         elif self.moving:
             self.set_cursor(Gdk.CursorType.FLEUR)
             if not self.move_action:
                 self.move_action = UndoManager.UndoAction (self, UNDO_MOVE, self.undo_move, self.move_origin,
                                                            self.selected)
+            # Moved thoughts report their old and new areas through
+            # update_links / update_view, so there's no need to repaint
+            # everything here
             for t in self.selected:
                 t.move_by (coords[0] - self.move_origin_new[0], coords[1] - self.move_origin_new[1])
             self.move_origin_new = (coords[0], coords[1])
-            self.invalidate ()
             return True
         elif event.state & Gdk.ModifierType.BUTTON2_MASK or \
                 event.state & Gdk.ModifierType.BUTTON1_MASK and self.translate:
@@ -466,11 +504,19 @@ class MMapArea (Gtk.DrawingArea):
     def find_object_at (self, coords):
         if self.focus and self.focus.includes(coords):
             return self.focus
-        for x in reversed(self.thoughts):
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
-                return x
-        for x in self.links:
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
+        if not coords:
+            return None
+        # Only thoughts near the pointer are asked, topmost first.  Links
+        # never take part in picking.
+        candidates = self.thought_index.query_point (coords[0], coords[1])
+        if self.hover and self.hover != self.focus and \
+           self.hover in self.thought_index and self.hover not in candidates:
+            # The pointer just left it: let it drop its resize state and cursor
+            self.hover.includes (coords)
+        self.hover = None
+        for x in reversed(candidates):
+            if x != self.focus and x.includes (coords):
+                self.hover = x
                 return x
         return None
 
@@ -565,7 +611,8 @@ class MMapArea (Gtk.DrawingArea):
             if self.selected.count (link) == 0:
                 self.selected.append (link)
         else:
-            map (lambda t : t.unselect(), self.selected)
+            for t in self.selected:
+                t.unselect ()
             self.selected = [link]
         link.select()
         self.emit("change_buffer", None)
@@ -585,14 +632,15 @@ class MMapArea (Gtk.DrawingArea):
         if thought in self.selected and self.moving:
             return
 
-        if thought not in self.thoughts:
-            self.thoughts.append(thought)
+        if thought not in self.thought_index:
+            self.add_thought (thought)
 
         if modifiers and (modifiers & Gdk.ModifierType.SHIFT_MASK or modifiers == -1):
             if self.selected.count (thought) == 0:
                 self.selected.append (thought)
         else:
-            map(lambda x : x.unselect(), self.selected)
+            for x in self.selected:
+                x.unselect ()
             self.selected = [thought]
         if thought.can_be_parent():
             self.current_root = []
@@ -612,20 +660,46 @@ class MMapArea (Gtk.DrawingArea):
         else:
             self.emit ("change_buffer", None)
 
+    def select_thoughts (self, thoughts):
+        ''' Adds thoughts to the selection in one go.  This is the same as \
+            calling select_thought with SHIFT held for each of them, \
+            without rebuilding the roots and notifying for every one'''
+        thoughts = [t for t in thoughts if t not in self.selected]
+        if not thoughts:
+            return
+        self.hookup_im_context ()
+        for t in thoughts:
+            if t not in self.thought_index:
+                self.add_thought (t)
+            self.selected.append (t)
+            t.select ()
+        if [t for t in thoughts if t.can_be_parent()]:
+            self.current_root = [x for x in self.selected if x.can_be_parent()]
+        if len(self.selected) == 1:
+            thought = self.selected[0]
+            self.emit ("thought_selection_changed", thought.background_color, thought.foreground_color)
+            self.background_color = thought.background_color
+            self.foreground_color = thought.foreground_color
+            try:
+                self.emit ("change_buffer", thought.extended_buffer)
+            except AttributeError:
+                self.emit ("change_buffer", None)
+            self.hookup_im_context (thought)
+        else:
+            self.emit ("change_buffer", None)
+
     def undo_link_action (self, action, mode):
         self.undo.block ()
         self.set_focus(None, None)
         link = action.args[0]
         if action.undo_type == UNDO_CREATE_LINK:
             if mode == UndoManager.REDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
+                self.add_link (link)
             else:
                 self.delete_link (link)
         elif action.undo_type == UNDO_DELETE_LINK:
             if mode == UndoManager.UNDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
+                self.add_link (link)
             else:
                 self.delete_link (link)
         elif action.undo_type == UNDO_STRENGTHEN_LINK:
@@ -633,6 +707,7 @@ class MMapArea (Gtk.DrawingArea):
                 link.set_strength (action.args[1])
             else:
                 link.set_strength (action.args[2])
+            self.update_link_index (link)
 
         self.undo.unblock ()
         self.invalidate ()
@@ -642,16 +717,16 @@ class MMapArea (Gtk.DrawingArea):
         link.connect ("update_view", self.update_view)
 
     def create_link (self, thought, thought_coords, child, child_coords = None, strength = 2):
-        for x in self.links:
-            if x.connects (thought, child):
-                if x.change_strength (thought, child):
-                    self.delete_link (x)
-                return
-        link = Link (self.save, parent = thought, child = child, strength = strength)
+        x = self.find_link (thought, child)
+        if x:
+            if x.change_strength (thought, child):
+                self.delete_link (x)
+            else:
+                self.update_link_index (x)
+            return
+        link = Link (parent = thought, child = child, strength = strength)
         self.connect_link (link)
-        element = link.get_save_element ()
-        self.element.appendChild (element)
-        self.links.append (link)
+        self.add_link (link)
 
         return link
 
@@ -660,15 +735,97 @@ class MMapArea (Gtk.DrawingArea):
             self.set_cursor (cursor_type)
 
     def update_all_links(self):
-        map(lambda l : l.find_ends(), self.links)
+        self.index_curves = utils.use_bezier_curves
+        for l in self.links:
+            l.find_ends ()
+            self.update_link_index (l)
 
     def update_links_cb (self, thought):
-        for x in self.links:
-            if x.uses (thought):
-                x.find_ends ()
+        self.update_index (thought)
+        for x in self.thought_links.get (thought, ()):
+            x.find_ends ()
+            self.update_link_index (x)
 
     def update_view (self, thought):
-        self.invalidate ()
+        if isinstance (thought, Link):
+            self.damage (thought.get_bounds ())
+            return
+        self.update_index (thought)
+        self.damage (self.thought_index.get_bounds (thought))
+
+    def thought_bounds (self, thought):
+        ''' The area in which thought reacts to the pointer '''
+        if not thought.ul or not thought.lr:
+            return None
+        s = thought.sensitive
+        return (thought.ul[0] - s, thought.ul[1] - s, thought.lr[0] + s, thought.lr[1] + s)
+
+    def update_index (self, thought):
+        ''' Refreshes the index entry of thought.  If it moved or changed \
+            size, both its old and new areas are damaged '''
+        bounds = self.thought_bounds (thought)
+        old = self.thought_index.update (thought, bounds)
+        if old != bounds and thought in self.thought_index:
+            self.damage (old)
+            self.damage (bounds)
+        return old
+
+    def update_link_index (self, link):
+        bounds = link.get_bounds ()
+        old = self.link_index.update (link, bounds)
+        if old != bounds:
+            self.damage (old)
+            self.damage (bounds)
+        return old
+
+    def add_thought (self, thought):
+        self.thoughts.append (thought)
+        self.thought_index.insert (thought, self.thought_bounds (thought))
+
+    def add_link (self, link):
+        self.links.append (link)
+        self.link_index.insert (link, link.get_bounds ())
+        self.index_link_ends (link)
+
+    def remove_link (self, link):
+        self.unindex_link_ends (link)
+        self.links.remove (link)
+        self.link_index.remove (link)
+
+    def index_link_ends (self, link):
+        ''' Files link under the thoughts it connects.  Links being loaded \
+            don't know their thoughts yet; finish_loading files them '''
+        if not link.parent or not link.child:
+            return
+        for t in set ((link.parent, link.child)):
+            self.thought_links.setdefault (t, []).append (link)
+        self.link_pairs[(link.parent, link.child)] = link
+
+    def unindex_link_ends (self, link):
+        for t in set ((link.parent, link.child)):
+            links = self.thought_links.get (t)
+            if links and link in links:
+                links.remove (link)
+                if not links:
+                    del self.thought_links[t]
+        if self.link_pairs.get ((link.parent, link.child)) is link:
+            del self.link_pairs[(link.parent, link.child)]
+
+    def links_of (self, thought):
+        ''' The links using thought '''
+        return list (self.thought_links.get (thought, ()))
+
+    def find_link (self, thought, thought2):
+        ''' The link between the two thoughts, whichever is the parent '''
+        return self.link_pairs.get ((thought, thought2)) or \
+               self.link_pairs.get ((thought2, thought))
+
+    def remove_thought (self, thought):
+        self.thoughts.remove (thought)
+        self.thought_index.remove (thought)
+        thought.drop_render_cache ()
+        if self.hover == thought:
+            self.hover = None
 
     def invalidate (self, transformed_area = None):
         '''Helper function to invalidate the entire screen, forcing a redraw'''
@@ -687,21 +844,51 @@ class MMapArea (Gtk.DrawingArea):
         if self.window:
             self.window.invalidate_rect (rect, True)
 
+    def damage (self, bounds):
+        ''' Marks the canvas area bounds (x0, y0, x1, y1) as needing a \
+            repaint.  Damage is collected into a single region which is \
+            handed to GDK just before the next redraw'''
+        if not bounds or not hasattr (self, "untransform"):
+            return
+        x0, y0 = self.untransform_coords (bounds[0], bounds[1])
+        x1, y1 = self.untransform_coords (bounds[2], bounds[3])
+        # Leave room for antialiasing and thick borders
+        x = int (math.floor (min (x0, x1))) - 2
+        y = int (math.floor (min (y0, y1))) - 2
+        w = int (math.ceil (abs (x1 - x0))) + 5
+        h = int (math.ceil (abs (y1 - y0))) + 5
+        if self.damaged is None:
+            self.damaged = cairo.Region ()
+        self.damaged.union (cairo.RectangleInt (x, y, w, h))
+        if self.damage_handler is None:
+            self.damage_handler = GObject.idle_add (self.flush_damage,
+                                                    priority = GObject.PRIORITY_HIGH_IDLE)
+
+    def flush_damage (self):
+        self.damage_handler = None
+        if self.damaged is not None and self.window:
+            self.window.invalidate_region (self.damaged, True)
+        self.damaged = None
+        return False
+
     def draw (self, widget, context):
         '''Draw the map and all the associated thoughts'''
-        ##area = event.area
-        alloc = self.get_allocation()
-        area = Gdk.Rectangle()
-        area.x = 0
-        area.y = 0
-
-        if type(alloc) == Gdk.Rectangle:
-            area.width = alloc.width
-            area.height = alloc.height
+        # GTK has already clipped context to the damaged region.  Anything
+        # outside of its extents is skipped below.
+        has_clip, area = Gdk.cairo_get_clip_rectangle (context)
+        if not has_clip:
+            alloc = self.get_allocation()
+            area = Gdk.Rectangle()
+            area.x = 0
+            area.y = 0
+
+            if type(alloc) == Gdk.Rectangle:
+                area.width = alloc.width
+                area.height = alloc.height
 
-        else:
-            area.width = alloc.get_width()
-            area.height = alloc.get_height()
+            else:
+                area.width = alloc.get_width()
+                area.height = alloc.get_height()
 
         context.rectangle (area.x, area.y, area.width, area.height)
         context.clip ()
@@ -716,22 +903,53 @@ class MMapArea (Gtk.DrawingArea):
         context.translate(-alloc.width/2., -alloc.height/2.)
         context.translate(self.translation[0], self.translation[1])
 
-        for l in self.links:
-            l.draw (context)
-
         self.untransform = context.get_matrix()
         self.transform = context.get_matrix()
         self.transform.invert()
 
+        # Decoded images and cached renderings used from here on stay
+        # until the next pass
+        ImageThought.decoded_images.begin_pass ()
+        render_caches.begin_pass ()
+
+        # Only paint what intersects the visible part of the canvas
         ax, ay = self.transform_coords(area.x, area.y)
         width  = area.width / self.scale_fac
         height = area.height / self.scale_fac
-        for t in self.thoughts:
-            try:
-                if t.lr[0] >= ax and t.ul[0] <= ax + width and t.lr[1] >= ay and t.ul[1] <= ay + height:
-                    t.draw (context)
-            except:
-                t.draw(context)
+
+        # Link bounds depend on whether curves are drawn, which may have
+        # been switched since the index was filled
+        if self.index_curves != utils.use_bezier_curves:
+            self.update_all_links ()
+
+        links = self.link_index.query_rect (ax, ay, ax + width, ay + height)
+        for l in links:
+            l.draw (context)
+
+        thoughts = self.thought_index.query_rect (ax, ay, ax + width, ay + height)
+        for t in thoughts:
+            if utils.use_render_cache:
+                t.draw_cached (context)
+            else:
+                t.draw (context)
+            # Drawing may have recalculated the thought's edges
+            self.update_index (t)
+        ImageThought.decoded_images.end_pass ()
+
+        if utils.use_render_cache:
+            # Nobody needs the caches of thoughts out of view
+            vx, vy = self.transform_coords (0, 0)
+            render_caches.drop_outside (vx, vy,
+                                        vx + alloc.width / self.scale_fac,
+                                        vy + alloc.height / self.scale_fac)
+
+        stats = self.draw_stats
+        stats["links_drawn"] = len (links)
+        stats["links_culled"] = len (self.links) - len (links)
+        stats["thoughts_drawn"] = len (thoughts)
+        stats["thoughts_culled"] = len (self.thoughts) - len (thoughts)
+        utils.print_debug ("draw: %(thoughts_drawn)d thoughts (%(thoughts_culled)d culled), "
+                           "%(links_drawn)d links (%(links_culled)d culled)" % stats)
 
         if self.is_bbox_selecting:
             xs = self.bbox_origin[0]
@@ -774,16 +992,14 @@ class MMapArea (Gtk.DrawingArea):
         else:
             self.emit ("change_mode", action.args[2])
             thought = action.args[0]
-            self.thoughts.append (thought)
+            self.add_thought (thought)
             for t in action.args[1]:
                 self.unselect_all ()
                 self.select_thought (t, -1)
             self.hookup_im_context (thought)
             self.emit ("change_buffer", thought.extended_buffer)
-            self.element.appendChild (thought.element)
             for l in action.args[5:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.add_link (l)
 
         self.emit ("set_focus", None, False)
         self.undo.unblock ()
@@ -797,24 +1013,22 @@ class MMapArea (Gtk.DrawingArea):
 
         if type == MODE_TEXT:
             # fixed<-_vbox<-_sw<-_main_area
-            thought = TextThought.TextThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color, fixed=self.get_parent().get_parent().get_parent().get_parent(), parent=self)
+            thought = TextThought.TextThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color, fixed=self.get_parent().get_parent().get_parent().get_parent(), parent=self)
         elif type == MODE_LABEL:
-            thought = LabelThought.LabelThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = LabelThought.LabelThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color)
         elif type == MODE_IMAGE:
-            thought = ImageThought.ImageThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = ImageThought.ImageThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color)
         elif type == MODE_DRAW:
-            thought = DrawingThought.DrawingThought (coords, self.pango_context, self.nthoughts, self.save, self.undo,    \
+            thought = DrawingThought.DrawingThought (coords, self.pango_context, self.nthoughts, self.undo,    \
                                                      loading,self.background_color, self.foreground_color)
         elif type == MODE_RESOURCE:
-            thought = ResourceThought.ResourceThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = ResourceThought.ResourceThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color)
         if not thought.okay ():
             return None
 
         if type == MODE_IMAGE:
             self.emit ("change_mode", self.old_mode)
         self.nthoughts += 1
-        element = thought.element
-        self.element.appendChild (thought.element)
         thought.connect ("select_thought", self.select_thought)
         thought.connect ("create_link", self.create_link)
         thought.connect ("update_view", self.update_view)
@@ -823,7 +1037,7 @@ class MMapArea (Gtk.DrawingArea):
         thought.connect ("update_links", self.update_links_cb)
         thought.connect ("grab_focus", self.regain_focus_cb)
         thought.connect ("update-attrs", self.update_attr_cb)
-        self.thoughts.append (thought)
+        self.add_thought (thought)
         return thought
 
     def regain_focus_cb (self, thought, ext):
@@ -841,9 +1055,7 @@ class MMapArea (Gtk.DrawingArea):
         if hasattr(thought, 'textview'):
             thought.remove_textview()
 
-        if thought.element in self.element.childNodes:
-            self.element.removeChild (thought.element)
-        self.thoughts.remove (thought)
+        self.remove_thought (thought)
         try:
             self.selected.remove (thought)
         except:
@@ -857,12 +1069,8 @@ class MMapArea (Gtk.DrawingArea):
             self.primary = None
             if self.thoughts:
                 self.make_primary (self.thoughts[0])
-        rem_links = []
-        for l in self.links:
-            if l.uses (thought):
-                if action: action.add_arg (l)
-                rem_links.append (l)
-        for l in rem_links:
+        for l in self.links_of (thought):
+            if action: action.add_arg (l)
             self.delete_link (l)
 
         for i, obj in enumerate(self.current_root):
@@ -880,12 +1088,10 @@ class MMapArea (Gtk.DrawingArea):
         if mode == UndoManager.UNDO:
             self.unselect_all ()
             for l in action.args[1:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.add_link (l)
             for t in action.args[0]:
-                self.thoughts.append (t)
+                self.add_thought (t)
                 self.select_thought (t, -1)
-                self.element.appendChild (t.element)
                 if t.am_primary and not self.primary:
                     self.emit ("change_buffer", action.args[0][0].extended_buffer)
                     self.make_primary(t)
@@ -910,12 +1116,11 @@ class MMapArea (Gtk.DrawingArea):
             tmp = self.selected
             t = tmp.pop()
             while t:
-                if t in self.thoughts:
-                    for l in self.links:
-                        if l.uses (t):
-                            action.add_arg (l)
+                if t in self.thought_index:
+                    for l in self.links_of (t):
+                        action.add_arg (l)
                     self.delete_thought (t)
-                if t in self.links:
+                if t in self.link_index:
                     self.delete_link (t)
                 if len (tmp) == 0:
                     t = None
@@ -928,14 +1133,21 @@ class MMapArea (Gtk.DrawingArea):
         self.invalidate ()
 
     def delete_link (self, link):
-        if link.element in self.element.childNodes:
-            self.element.removeChild (link.element)
-        #link.element.unlink ()
         try:
-            self.links.remove (link)
+            self.remove_link (link)
         except:
             pass
 
+    def delete_links (self, links):
+        ''' Deletes many links at once, without undo '''
+        dead = set (links)
+        if not dead:
+            return
+        for link in dead:
+            self.unindex_link_ends (link)
+            self.link_index.remove (link)
+        self.links = [l for l in self.links if l not in dead]
+
     def find_related_thought (self, radians):
         # Find thought within angle
         best = None
@@ -973,7 +1185,7 @@ class MMapArea (Gtk.DrawingArea):
         if len(self.selected) != 1:
             return None
         initial = self.selected[0]
-        for x in self.links:
+        for x in self.thought_links.get (initial, ()):
             if x.parent == initial:
                 other = x.child
             elif x.child == initial:
@@ -1092,31 +1304,47 @@ class MMapArea (Gtk.DrawingArea):
         thought = self.create_new_thought (None, type, loading = True)
         thought.creating = False
         thought.load (node, tar)
+        self.update_index (thought)
 
     def load_link (self, node):
-        link = Link (self.save)
+        link = Link ()
         self.connect_link (link)
         link.load (node)
-        self.links.append (link)
-        element = link.get_save_element ()
-        self.element.appendChild (element)
+        self.add_link (link)
+
+    def load_thyself (self, top_element, events, tar):
+        ''' Loads the map from events, an ElementTree.iterparse iterator \
+            (with 'start' and 'end' events) that has just returned the \
+            start of top_element.  Each thought or link is created as soon \
+            as its element is complete, and the element is dropped \
+            afterwards so the parsed tree never grows past one element'''
+        depth = 0
+        for event, node in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth < 0:
+                # The end of top_element
+                break
+            if depth > 0:
+                continue
 
-    def load_thyself (self, top_element, doc, tar):
-        for node in top_element.childNodes:
-            if node.nodeName == "thought":
+            if node.tag == "thought":
                 self.load_thought (node, MODE_TEXT, tar)
-            elif node.nodeName == "label_thought":
+            elif node.tag == "label_thought":
                 self.load_thought (node, MODE_LABEL, tar)
-            elif node.nodeName == "image_thought":
+            elif node.tag == "image_thought":
                 self.load_thought (node, MODE_IMAGE, tar)
-            elif node.nodeName == "drawing_thought":
+            elif node.tag == "drawing_thought":
                 self.load_thought (node, MODE_DRAW, tar)
-            elif node.nodeName == "res_thought":
+            elif node.tag == "res_thought":
                 self.load_thought (node, MODE_RESOURCE, tar)
-            elif node.nodeName == "link":
+            elif node.tag == "link":
                 self.load_link (node)
             else:
-                print ("Warning: Unknown element type.  Ignoring: "+node.nodeName)
+                print ("Warning: Unknown element type.  Ignoring: "+node.tag)
+            del top_element[:]
 
         self.finish_loading ()
 
@@ -1143,35 +1371,56 @@ class MMapArea (Gtk.DrawingArea):
                    self.selected[0].foreground_color)
         else:
             self.emit ("change_buffer", None)
+        by_identity = {}
+        for t in self.thoughts:
+            by_identity.setdefault (t.identity, t)
         del_links = []
         for l in self.links:
             if (l.parent_number == -1 and l.child_number == -1) or \
                (l.parent_number == l.child_number):
                 del_links.append (l)
                 continue
-            parent = child = None
-            for t in self.thoughts:
-                if t.identity == l.parent_number:
-                    parent = t
-                elif t.identity == l.child_number:
-                    child = t
-                if parent and child:
-                    break
-            l.set_parent_child (parent, child)
+            l.set_parent_child (by_identity.get (l.parent_number),
+                                by_identity.get (l.child_number))
             if not l.parent or not l.child:
                 del_links.append (l)
-        for l in del_links:
-            self.delete_link (l)
-
-    def update_save(self):
-        for t in self.thoughts:
-            t.update_save ()
-        for l in self.links:
-            l.update_save ()
-
-    def save_thyself(self, tar):
+                continue
+            self.update_link_index (l)
+            self.index_link_ends (l)
+        self.delete_links (del_links)
+
+    def get_save_fragments (self):
+        ''' A utils.SaveFragment for every thought and link.  Only the \
+            ones that changed since the last save take a new record; the \
+            XML is made from them by the save thread '''
+        fragments = [t.get_save_fragment () for t in self.thoughts]
+        fragments.extend ([l.get_save_fragment () for l in self.links])
+        return fragments
+
+    def get_save_files (self):
+        ''' The (name, data) pairs to store next to the manifest.  Files \
+            with the same content are stored once, and different files \
+            that happen to share a name are renamed apart.  Call this \
+            before get_save_fragments, as renaming changes the manifest '''
+        files = []
+        digests = {}    # name -> digest of the file stored under it
+        names = {}      # digest -> name it is stored under
         for t in self.thoughts:
-            t.save(tar)
+            for name, data, digest in t.get_save_files ():
+                if digest in names:
+                    t.rename_save_file (name, names[digest])
+                    continue
+                if name in digests:
+                    base, ext = os.path.splitext (name)
+                    n = 1
+                    while "%s-%d%s" % (base, n, ext) in digests:
+                        n += 1
+                    t.rename_save_file (name, "%s-%d%s" % (base, n, ext))
+                    name = "%s-%d%s" % (base, n, ext)
+                digests[name] = digest
+                names[digest] = name
+                files.append ((name, data))
+        return files
 
     def text_selection_cb (self, thought, start, end, text):
         self.emit ("text_selection_changed", start, end, text)
@@ -1244,10 +1493,7 @@ class MMapArea (Gtk.DrawingArea):
     def thoughts_are_linked (self):
         if len (self.selected) != 2:
             return False
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                return True
-        return False
+        return self.find_link (self.selected[0], self.selected[1]) is not None
 
     def drag_menu_cb(self, sw, mode):
         if len(self.selected) == 1:
@@ -1309,11 +1555,7 @@ class MMapArea (Gtk.DrawingArea):
         if not self.selected[0].can_be_parent() or \
             not self.selected[1].can_be_parent():
                 return
-        lnk = None
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                lnk = l
-                break
+        lnk = self.find_link (self.selected[0], self.selected[1])
         if lnk:
             self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DELETE_LINK, self.undo_link_action, lnk))
             self.delete_link (lnk)
@@ -1393,9 +1635,8 @@ class MMapArea (Gtk.DrawingArea):
         thought.background_color = self.background_color
         act = UndoManager.UndoAction (self, UNDO_CREATE, self.undo_create_cb, thought, sel, \
                                       self.mode, self.old_mode, event.get_coords())
-        for l in self.links:
-            if l.uses (thought):
-                act.add_arg (l)
+        for l in self.links_of (thought):
+            act.add_arg (l)
         """
         if self.undo.peak ().undo_type == UNDO_DELETE_SINGLE:
             last_action = self.undo.pop ()
@@ -1412,6 +1653,108 @@ class MMapArea (Gtk.DrawingArea):
         thought.process_button_down(event, coords)
         self.focus = thought
 
+class Selection (object):
+    ''' The selected thoughts and links, in the order they were selected.  \
+        It behaves like a list without duplicates, but is kept in an \
+        ordered dictionary, so membership tests and removals don't have \
+        to scan it.  Indexing from the front is cheap; anything that \
+        changes the order in the middle rebuilds it'''
+
+    def __init__ (self, items = ()):
+        self.members = OrderedDict ()
+        self.extend (items)
+
+    def __copy__ (self):
+        return Selection (self)
+
+    def __repr__ (self):
+        return "Selection (%r)" % list (self)
+
+    def __len__ (self):
+        return len (self.members)
+
+    def __iter__ (self):
+        return iter (self.members)
+
+    def __contains__ (self, item):
+        return item in self.members
+
+    def __eq__ (self, other):
+        return list (self) == list (other)
+
+    def __ne__ (self, other):
+        return not self == other
+
+    def __getitem__ (self, index):
+        if isinstance (index, slice):
+            return list (self)[index]
+        if index < 0:
+            index += len (self.members)
+        if not 0 <= index < len (self.members):
+            raise IndexError ("Selection index out of range")
+        return next (itertools.islice (self.members, index, None))
+
+    def __setitem__ (self, index, value):
+        items = list (self)
+        items[index] = value
+        self.__reset (items)
+
+    def __delitem__ (self, index):
+        if isinstance (index, slice):
+            for item in self[index]:
+                del self.members[item]
+        else:
+            del self.members[self[index]]
+
+    def __iadd__ (self, items):
+        self.extend (items)
+        return self
+
+    def __reset (self, items):
+        self.members.clear ()
+        self.extend (items)
+
+    def count (self, item):
+        return 1 if item in self.members else 0
+
+    def index (self, item):
+        if item not in self.members:
+            raise ValueError ("%r is not selected" % (item,))
+        for i, member in enumerate (self.members):
+            if member == item:
+                return i
+
+    def append (self, item):
+        ''' Adds item at the end, unless it is selected already '''
+        if item not in self.members:
+            self.members[item] = None
+
+    def extend (self, items):
+        for item in items:
+            self.append (item)
+
+    def insert (self, index, item):
+        if item in self.members:
+            return
+        items = list (self)
+        items.insert (index, item)
+        self.__reset (items)
+
+    def remove (self, item):
+        if item not in self.members:
+            raise ValueError ("%r is not selected" % (item,))
+        del self.members[item]
+
+    def pop (self, index = -1):
+        if index == -1 and self.members:
+            return self.members.popitem ()[0]
+        item = self[index]
+        del self.members[item]
+        return item
+
+    def clear (self):
+        self.members.clear ()
+
 class CursorFactory:
     __shared_state = {"cursors": {}}
 
@@ -34,8 +34,8 @@ from gi.repository import Pango
 
 
 class ResourceThought (TextThought.TextThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
-        super (ResourceThought, self).__init__(coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, "res_thought")
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color):
+        super (ResourceThought, self).__init__(coords, pango_context, thought_number, undo, loading, background_color, foreground_color, "res_thought")
 
         self.uri = ""
 
@@ -74,13 +74,17 @@ class ResourceThought (TextThought.TextThought):
         elif event.button == 3:
             self.emit ("popup_requested", event, 1)
             
-    def update_save (self):
-        super(ResourceThought, self).update_save()
-        self.element.setAttribute ("uri", self.uri)
+    def get_save_key (self):
+        return super(ResourceThought, self).get_save_key() + (self.uri,)
+
+    def get_save_record (self):
+        tag, attrs, children = super(ResourceThought, self).get_save_record()
+        attrs.append (("uri", self.uri))
+        return (tag, attrs, children)
         
-    def load (self, node):
-        super(ResourceThought, self).load(node)
-        self.uri = node.getAttribute ("uri")
+    def load (self, node, tar):
+        super(ResourceThought, self).load(node, tar)
+        self.uri = node.get ("uri", "")
         self.glade.get_object('urlEntry').set_text(self.uri)
         
     def draw (self, context):
@@ -0,0 +1,138 @@
+# SaveThread.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import os
+import shutil
+import logging
+import threading
+
+from gi.repository import Gtk
+from gi.repository import GObject
+
+class SaveJob:
+    ''' One request to write a snapshot of the map.  writer is called \
+        on the save thread with the path to write to, so it must only \
+        use data that was copied out of the map beforehand '''
+
+    def __init__ (self, path, writer):
+        self.paths = [path]
+        self.writer = writer
+        # Set on the save thread once written; finished follows on the
+        # main loop
+        self.done = threading.Event ()
+        self.finished = False
+        self.error = None
+        # The newer job that took over our paths, if any
+        self.superseded_by = None
+
+    def current (self):
+        job = self
+        while job.superseded_by:
+            job = job.superseded_by
+        return job
+
+class SaveThread (threading.Thread):
+    ''' Writes saves away from the main loop.  Only one job waits at a \
+        time: a newer one replaces it and also writes to its paths, so \
+        every path ends up with the latest snapshot.  Completion is \
+        reported back on the main loop'''
+
+    def __init__ (self):
+        super (SaveThread, self).__init__ ()
+        self.daemon = True
+        self.condition = threading.Condition ()
+        self.pending = None
+        # Whether wait is running the main loop
+        self.waiting = False
+
+    def save (self, path, writer):
+        job = SaveJob (path, writer)
+        self.condition.acquire ()
+        try:
+            if self.pending:
+                # The same path may be handed to us more than once
+                paths = []
+                for path in self.pending.paths + job.paths:
+                    if path not in paths:
+                        paths.append (path)
+                job.paths = paths
+                self.pending.superseded_by = job
+            self.pending = job
+            self.condition.notify ()
+        finally:
+            self.condition.release ()
+        return job
+
+    def wait (self, job):
+        ''' Keeps the main loop running until job (or the job that \
+            superseded it) has been written.  Raises its error, if any.  \
+            When called again from a handler run by that loop, it blocks \
+            instead, so main loops never nest more than one deep '''
+        if self.waiting:
+            job.current ().done.wait ()
+        else:
+            self.waiting = True
+            try:
+                while not job.current ().finished:
+                    Gtk.main_iteration ()
+            finally:
+                self.waiting = False
+        if job.current ().error:
+            raise job.current ().error
+
+    def run (self):
+        while True:
+            self.condition.acquire ()
+            try:
+                while not self.pending:
+                    self.condition.wait ()
+                job = self.pending
+                self.pending = None
+            finally:
+                self.condition.release ()
+
+            try:
+                self.write (job)
+            except Exception as e:
+                logging.exception ("Saving to %s failed", job.paths[0])
+                job.error = e
+            job.done.set ()
+            GObject.idle_add (self.finished, job)
+
+    def write (self, job):
+        self.replace (job.paths[0], job.writer)
+        for path in job.paths[1:]:
+            if os.path.abspath (path) != os.path.abspath (job.paths[0]):
+                self.replace (path, lambda tmp_path: shutil.copyfile (job.paths[0], tmp_path))
+
+    def replace (self, path, writer):
+        ''' Has writer write next to path, then renames the result over \
+            it.  A half-written file never replaces a good one, and a map \
+            still memory mapped from path keeps its old content '''
+        tmp_path = path + ".part"
+        try:
+            writer (tmp_path)
+            os.rename (tmp_path, path)
+        finally:
+            if os.path.exists (tmp_path):
+                os.unlink (tmp_path)
+
+    def finished (self, job):
+        job.finished = True
+        return False
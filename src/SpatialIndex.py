@@ -0,0 +1,162 @@
+# SpatialIndex.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import math
+
+# Size (in canvas units) of one grid cell.  Thoughts are typically
+# 100x70, so a cell holds a few of them at most.
+CELL_SIZE = 128
+
+class SpatialIndex:
+    ''' A uniform grid over the canvas.  Every object is filed under each \
+        cell its bounding box touches, so point and rectangle queries only \
+        look at objects near the query instead of at all of them.  The \
+        index also remembers the order objects were inserted in, so \
+        results can be returned bottom-to-top just like the lists \
+        in MMapArea'''
+
+    def __init__ (self, cell_size = CELL_SIZE):
+        self.cell_size = float (cell_size)
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        # Objects that don't know their extent yet (e.g. while loading).
+        # They are returned by every query.
+        self.loose = set ()
+        self.sequence = 0
+
+    def __contains__ (self, obj):
+        return obj in self.order
+
+    def __len__ (self):
+        return len (self.order)
+
+    def clear (self):
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        self.loose = set ()
+
+    def cell_range (self, bounds):
+        size = self.cell_size
+        return (int (math.floor (bounds[0] / size)), int (math.floor (bounds[1] / size)),
+                int (math.floor (bounds[2] / size)), int (math.floor (bounds[3] / size)))
+
+    def __file (self, obj, bounds):
+        if bounds is None:
+            self.loose.add (obj)
+            return
+        self.bounds[obj] = bounds
+        x0, y0, x1, y1 = self.cell_range (bounds)
+        for cx in range (x0, x1 + 1):
+            for cy in range (y0, y1 + 1):
+                self.cells.setdefault ((cx, cy), set ()).add (obj)
+
+    def __unfile (self, obj):
+        bounds = self.bounds.pop (obj, None)
+        if bounds is None:
+            self.loose.discard (obj)
+            return
+        x0, y0, x1, y1 = self.cell_range (bounds)
+        for cx in range (x0, x1 + 1):
+            for cy in range (y0, y1 + 1):
+                cell = self.cells.get ((cx, cy))
+                if cell is None:
+                    continue
+                cell.discard (obj)
+                if not cell:
+                    del self.cells[(cx, cy)]
+
+    def insert (self, obj, bounds = None):
+        ''' Adds obj on top of everything already in the index.  bounds \
+            is (x0, y0, x1, y1) or None if it isn't known yet'''
+        if obj in self.order:
+            self.__unfile (obj)
+        self.sequence += 1
+        self.order[obj] = self.sequence
+        self.__file (obj, bounds)
+
+    def remove (self, obj):
+        if obj not in self.order:
+            return
+        self.__unfile (obj)
+        del self.order[obj]
+
+    def update (self, obj, bounds):
+        ''' Moves obj to its new bounds, keeping its stacking order.  \
+            Returns the previous bounds (None if they weren't known)'''
+        if obj not in self.order:
+            return None
+        old = self.bounds.get (obj)
+        if old == bounds:
+            return old
+        if old is not None and bounds is not None and \
+           self.cell_range (old) == self.cell_range (bounds):
+            self.bounds[obj] = bounds
+            return old
+        self.__unfile (obj)
+        self.__file (obj, bounds)
+        return old
+
+    def get_bounds (self, obj):
+        return self.bounds.get (obj)
+
+    def sort (self, objs):
+        ''' Returns objs ordered bottom-to-top '''
+        order = self.order
+        return sorted (objs, key = lambda o: order[o])
+
+    def query_point (self, x, y):
+        ''' Returns the objects whose bounds contain (x, y), bottom-to-top '''
+        size = self.cell_size
+        cell = self.cells.get ((int (math.floor (x / size)), int (math.floor (y / size))))
+        found = list (self.loose)
+        if cell:
+            bounds = self.bounds
+            for obj in cell:
+                b = bounds[obj]
+                if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                    found.append (obj)
+        return self.sort (found)
+
+    def query_rect (self, x0, y0, x1, y1):
+        ''' Returns the objects whose bounds overlap the given rectangle, \
+            bottom-to-top '''
+        if x0 > x1:
+            x0, x1 = x1, x0
+        if y0 > y1:
+            y0, y1 = y1, y0
+        bounds = self.bounds
+        cx0, cy0, cx1, cy1 = self.cell_range ((x0, y0, x1, y1))
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len (bounds):
+            # Walking the cells would cost more than looking at everything
+            candidates = bounds
+        else:
+            candidates = set ()
+            for cx in range (cx0, cx1 + 1):
+                for cy in range (cy0, cy1 + 1):
+                    cell = self.cells.get ((cx, cy))
+                    if cell:
+                        candidates.update (cell)
+        found = list (self.loose)
+        for obj in candidates:
+            b = bounds[obj]
+            if b[2] >= x0 and b[0] <= x1 and b[3] >= y0 and b[1] <= y1:
+                found.append (obj)
+        return self.sort (found)
@@ -36,23 +36,25 @@ class ExtendedBuffer(Gtk.TextBuffer):
                                             GObject.TYPE_NONE,
                                             (GObject.TYPE_BOOLEAN, GObject.TYPE_BOOLEAN, GObject.TYPE_BOOLEAN, Pango.FontDescription)))
 
-    def __init__(self, undo_manager, save, save_doc):
+    def __init__(self, undo_manager):
         super (Gtk.TextBuffer, self).__init__()
 
         self.undo = undo_manager
         self.connect('insert-text', self.insert_text_cb)
         self.connect_after('insert-text', self.apply_attrs_cb)
         self.connect('delete-range', self.delete_range_cb)
-        self.text_elem = save_doc.createTextNode ("Extended")
-        self.save = save_doc
-        self.element = save
-        self.element.appendChild(self.text_elem)
         self.bold_tag = self.create_tag("bold", weight=Pango.Weight.BOLD)
         self.italics_tag = self.create_tag("italics", style=Pango.Style.ITALIC)
         self.underline_tag = self.create_tag("underline", underline=Pango.Underline.SINGLE)
         self.current_tags = []
         self.requested_tags = []
         self.connect_after('mark-set',self.mark_set_cb)
+        # Bumped on every change that shows up in the save record
+        self.version = 0
+        self.connect('changed', self.bump_version)
+        self.connect('apply-tag', self.bump_version)
+        self.connect('remove-tag', self.bump_version)
+        self.connect('mark-set', self.bump_version)
         self.bold_block = False
         self.italic_block = False
 
@@ -99,6 +101,9 @@ class ExtendedBuffer(Gtk.TextBuffer):
             self.apply_tag_by_name(x, prev_iter, iter)
         return False
 
+    def bump_version(self, *args):
+        self.version += 1
+
     def mark_set_cb(self, buffer, iter, mark, *params):
         italics = underline = bold = False
         if iter.has_tag(self.bold_tag):
@@ -126,74 +131,47 @@ class ExtendedBuffer(Gtk.TextBuffer):
         self.emit("set_attrs", bold, italics, underline, None)
         return False
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        self.text_elem.replaceWholeText (self.get_text())
+    def get_save_record (self):
         mark = self.get_insert()
         it = self.get_iter_at_mark(mark)
-        self.element.setAttribute("mark", str(it.get_offset()))
+        children = [self.get_text()]
         iter = self.get_start_iter()
         cur = 0
         tags = {}
-        doc = self.element.ownerDocument
         tag_table = self.get_tag_table()
         while(1):
-            if iter.begins_tag(tag_table.lookup("bold")):
-                tags["bold"] = cur
-            if iter.ends_tag(tag_table.lookup("bold")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("bold")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "bold")
-            if iter.begins_tag(tag_table.lookup("italics")):
-                tags["italics"] = cur
-            if iter.ends_tag(tag_table.lookup("italics")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("italics")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "italics")
-            if iter.begins_tag(tag_table.lookup("underline")):
-                tags["underline"] = cur
-            if iter.ends_tag(tag_table.lookup("underline")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("underline")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "underline")
+            for name in ("bold", "italics", "underline"):
+                tag = tag_table.lookup(name)
+                if iter.begins_tag(tag):
+                    tags[name] = cur
+                if iter.ends_tag(tag):
+                    start = tags.pop(name)
+                    children.append(("attribute", [("start", str(start)),
+                                                   ("end", str(cur)),
+                                                   ("type", name)], []))
             cur+=1
             if not iter.forward_char():
                 break
         for x in tags:
-            elem = doc.createElement ("attribute")
-            self.element.appendChild (elem)
-            elem.setAttribute("start", str(tags[x]))
-            elem.setAttribute("end", str(-1))
-            elem.setAttribute("type", x)
+            children.append(("attribute", [("start", str(tags[x])),
+                                           ("end", str(-1)),
+                                           ("type", x)], []))
+        return ("Extended", [("mark", str(it.get_offset()))], children)
 
     def load(self, node):
+        def load_text(data):
+            if data and data != "LABYRINTH_AUTOGEN_TEXT_REMOVE":
+                self.set_text(data)
+
         mark = None
-        if node.hasAttribute("mark"):
-            mark = int(node.getAttribute("mark"))
-        for n in node.childNodes:
-            if n.nodeType == n.TEXT_NODE:
-                if n.data != "LABYRINTH_AUTOGEN_TEXT_REMOVE":
-                    self.set_text(n.data)
-            elif n.nodeName == "attribute":
-                attrType = n.getAttribute("type")
-                start = int(n.getAttribute("start"))
-                end = int(n.getAttribute("end"))
+        if "mark" in node.attrib:
+            mark = int(node.get("mark"))
+        load_text(node.text)
+        for n in node:
+            if n.tag == "attribute":
+                attrType = n.get("type")
+                start = int(n.get("start"))
+                end = int(n.get("end"))
                 start_it = self.get_iter_at_offset(start)
                 if end >= 0:
                     end_it = self.get_iter_at_offset(end)
@@ -202,7 +180,8 @@ class ExtendedBuffer(Gtk.TextBuffer):
 
                 self.apply_tag_by_name(attrType, start_it, end_it)
             else:
-                print ("Error: Unknown type: %s.  Ignoring." % n.nodeName)
+                print ("Error: Unknown type: %s.  Ignoring." % n.tag)
+            load_text(n.tail)
         if mark:
             ins_iter = self.get_iter_at_offset(mark)
             self.move_mark_by_name("insert", ins_iter)
@@ -29,7 +29,6 @@
 from gi.repository import Gtk, Gdk, Pango, PangoCairo
 
 import os
-import xml.dom
 
 import utils
 import BaseThought
@@ -43,17 +42,15 @@ UNDO_REMOVE_ATTR=66
 UNDO_REMOVE_ATTR_SELECTION=67
 
 class TextThought (ResizableThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo,
+    def __init__ (self, coords, pango_context, thought_number, undo,
               loading, background_color, foreground_color, name="thought",
               fixed=None, parent=None):
-        super(TextThought, self).__init__(coords, save, name, undo, background_color, foreground_color)
+        super(TextThought, self).__init__(coords, name, undo, background_color, foreground_color)
 
         self.index = 0
         self.end_index = 0
         self.bytes = ""
         self.bindex = 0
-        self.text_element = save.createTextNode ("GOOBAH")
-        self.element.appendChild (self.text_element)
         self.layout = None
         self.identity = thought_number
         self.pango_context = pango_context
@@ -192,6 +189,7 @@ class TextThought (ResizableThought):
             change = len(string)
 
         self.text = left + string + right
+        self.content_changed ()
         self.undo.add_undo (UndoManager.UndoAction (self, UndoManager.INSERT_LETTER, self.undo_text_action,
                             self.bindex, string, len(string), self.attributes, []))
         self.index += len (string)
@@ -369,6 +367,7 @@ class TextThought (ResizableThought):
         self.text = left+right
         self.bytes = bleft+bright
         self.end_index = self.index
+        self.content_changed ()
 
     def backspace_char (self):
         if self.index == self.end_index == 0:
@@ -403,6 +402,7 @@ class TextThought (ResizableThought):
         self.text = left+right
         self.bytes = bleft+bright
         self.end_index = self.index
+        self.content_changed ()
 
         self.undo.add_undo(UndoManager.UndoAction (self, UndoManager.DELETE_LETTER, self.undo_text_action,
                            self.b_f_i (self.index), local_text, len(local_text), local_bytes, old_attrs,
@@ -670,6 +670,7 @@ class TextThought (ResizableThought):
             buffer.remove_tag(self.tag_underline, start, end)
 
         buffer.apply_tag(self.tag_font, start, end);
+        self.content_changed ()
 
     def _textview_copy_cb(self, widget=None, event=None):
         self.textview.get_buffer().copy_clipboard(self._clipboard)
@@ -768,85 +769,19 @@ class TextThought (ResizableThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        if self.text_element.parentNode is not None:
-            self.text_element.replaceWholeText (self.text)
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute("cursor", str(self.index))
-        self.element.setAttribute("ul-coords", str(self.ul))
-        self.element.setAttribute("lr-coords", str(self.lr))
-        self.element.setAttribute("identity", str(self.identity))
-        self.element.setAttribute("background-color", utils.color_to_string(self.background_color))
-        self.element.setAttribute("foreground-color", utils.color_to_string(self.foreground_color))
-
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-
-            except xml.dom.NotFoundErr:
-                pass
-
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true");
-
-        else:
-            try:
-                self.element.removeAttribute ("primary_root")
+    def get_save_record (self):
+        attrs = [("cursor", str(self.index)),
+                 ("ul-coords", str(self.ul)),
+                 ("lr-coords", str(self.lr)),
+                 ("identity", str(self.identity)),
+                 ("background-color", utils.color_to_string(self.background_color)),
+                 ("foreground-color", utils.color_to_string(self.foreground_color))]
+        attrs.extend (self.get_state_attributes ())
+        children = self.get_extended_records ()
+        if self.text:
+            children.append (self.text)
+        return (self.elem_type, attrs, children)
 
-            except xml.dom.NotFoundErr:
-                pass
-
-        doc = self.element.ownerDocument
-        """
-        while (1):
-            r = it.range()
-            for x in it.get_attrs():
-                if x.type == Pango.Weight and x.value == Pango.Weight.BOLD:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "bold")
-                elif x.type == Pango.Style and x.value == Pango.Style.ITALIC:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "italics")
-                elif x.type == Pango.Underline and x.value == Pango.Underline.SINGLE:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "underline")
-                elif x.type == Pango.AttrFontDesc:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "font")
-                    elem.setAttribute("value", x.desc.to_string ())
-            if not it.next():
-                break
-        """
     def rebuild_byte_table (self):
         # Build the Byte table
         del self.bytes
@@ -872,37 +807,37 @@ class TextThought (ResizableThought):
         self.text = tmp
 
     def load (self, node, tar):
-        self.index = 0 ##int (node.getAttribute ("cursor"))
+        self.index = 0 ##int (node.get ("cursor"))
         self.end_index = self.index
-        tmp = node.getAttribute ("ul-coords")
+        tmp = node.get ("ul-coords")
         self.ul = utils.parse_coords (tmp)
-        tmp = node.getAttribute ("lr-coords")
+        tmp = node.get ("lr-coords")
         self.lr = utils.parse_coords (tmp)
 
         self.width = self.lr[0] - self.ul[0]
         self.height = self.lr[1] - self.ul[1]
 
-        self.identity = 0 ##int (node.getAttribute ("identity"))
+        self.identity = 0 ##int (node.get ("identity"))
         try:
-            tmp = node.getAttribute ("background-color")
+            tmp = node.get ("background-color", "")
             self.background_color = Gdk.Color.parse(tmp)
-            tmp = node.getAttribute ("foreground-color")
+            tmp = node.get ("foreground-color", "")
             self.foreground_color = Gdk.Color.parse(tmp)
         except ValueError:
             pass
 
-        self.am_selected = node.hasAttribute ("current_root")
-        self.am_primary = node.hasAttribute ("primary_root")
+        self.am_selected = "current_root" in node.attrib
+        self.am_primary = "primary_root" in node.attrib
 
-        for n in node.childNodes:
-            if n.nodeType == n.TEXT_NODE:
-                self.text = n.data
-            elif n.nodeName == "Extended":
+        if node.text:
+            self.text = node.text
+        for n in node:
+            if n.tag == "Extended":
                 self.extended_buffer.load(n)
-            elif n.nodeName == "attribute":
-                attrType = n.getAttribute("type")
-                start = int(n.getAttribute("start"))
-                end = int(n.getAttribute("end"))
+            elif n.tag == "attribute":
+                attrType = n.get("type")
+                start = int(n.get("start"))
+                end = int(n.get("end"))
 
                 if attrType == "bold":
                     self.attributes["bold"] = True
@@ -913,7 +848,9 @@ class TextThought (ResizableThought):
                 ##elif attrType == "font":
                 ##    self.attributes["font"] = font
             else:
-                print ("Unknown: "+n.nodeName)
+                print ("Unknown: "+n.tag)
+            if n.tail:
+                self.text = n.tail
         self.rebuild_byte_table ()
         self.recalc_edges()
 
@@ -936,6 +873,7 @@ class TextThought (ResizableThought):
         right = self.text[offset+n_chars:]
         local_text = self.text[offset:offset+n_chars]
         self.text = left+right
+        self.content_changed ()
         self.rebuild_byte_table ()
         new = len(self.text)
         if self.index > len(self.text):
@@ -1025,6 +963,7 @@ class TextThought (ResizableThought):
                 pass##self.attributes = action.args[1].copy()
             elif action.undo_type == UNDO_ADD_ATTR_SELECTION:
                 pass##self.attributes = action.args[1].copy()
+        self.content_changed ()
         self.recalc_edges()
         self.emit("update_view")
         self.undo.unblock()
@@ -1133,6 +1072,7 @@ class TextThought (ResizableThought):
 
         self.textview.get_buffer().remove_tag(self.tag_font)
         self.tag_font = self.textview.get_buffer().create_tag("font", self.attributes["font"])
+        self.content_changed ()
 
         if start == end:
             self.undo.add_undo(UndoManager.UndoAction(self, UNDO_ADD_ATTR,
@@ -24,14 +24,22 @@
 # that can be accessed from anywhere :)
 
 import sys
+import re
 from os.path import *
 import os
-from array import array
+from io import StringIO
+from collections import OrderedDict
+from xml.sax.saxutils import XMLGenerator
 
-# Not available on OLPC's XO, but not needed neither
-#from Numeric import *
+# Not available on OLPC's XO, where pixbuf_to_cairo falls back to
+# plain byte strings
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from gi.repository import Gdk
+from gi.repository import GdkPixbuf
 
 try:
     # Sugar specific modules
@@ -47,6 +55,87 @@ def color_to_string(color):
 
     return '#%04x%04x%04x' % (color.red, color.green, color.blue)
 
+def pixbuf_from_data(data):
+    ''' Decodes image data in any format GdkPixbuf knows about '''
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write(data)
+    loader.close()
+    return loader.get_pixbuf()
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def png_from_data(data):
+    ''' Returns image data as PNG, re-encoding it unless it is PNG \
+        already.  Maps store their pictures as PNG: older versions only \
+        read that format '''
+    if bytes(data[:len(PNG_SIGNATURE)]) == PNG_SIGNATURE:
+        return data
+    success, buffer = pixbuf_from_data(data).save_to_bufferv('png', [], [])
+    return buffer
+
+def write_save_record(out, record):
+    ''' Writes record with the XMLGenerator out.  A save record is \
+        (tag, [(attribute, value), ...], [child, ...]) where each child \
+        is either another record or a string of text '''
+    tag, attrs, children = record
+    out.startElement(tag, OrderedDict(attrs))
+    for child in children:
+        if isinstance(child, tuple):
+            write_save_record(out, child)
+        else:
+            out.characters(child)
+    out.endElement(tag)
+
+def save_record_to_fragment(record):
+    ''' Returns record serialized as a piece of XML text '''
+    buf = StringIO()
+    out = XMLGenerator(buf, "utf-8", short_empty_elements=True)
+    write_save_record(out, record)
+    return buf.getvalue()
+
+class SaveFragment:
+    ''' A thought or link as it is to be saved.  The record is taken on \
+        the main loop when something changed; the XML text is only made \
+        from it on the save thread, once, and kept for later saves '''
+
+    def __init__(self, key, record):
+        self.key = key
+        self.record = record
+        self.text = None
+
+    def get_text(self):
+        if self.text is None:
+            self.text = save_record_to_fragment(self.record)
+            self.record = None
+        return self.text
+
+class FragmentGenerator(XMLGenerator):
+    ''' An XMLGenerator that can also insert pieces of XML serialized \
+        beforehand.  It doesn't use short empty elements, so every start \
+        tag is complete as soon as startElement returns and nothing is \
+        held back when such a piece is written to the stream '''
+
+    def __init__(self, stream, encoding):
+        XMLGenerator.__init__(self, stream, encoding)
+        self.stream = stream
+
+    def raw(self, text):
+        ''' Writes text, which must be well formed XML, as it is '''
+        self.stream.write(text)
+
+def save_fragments_to_xml(tag, attrs, fragments):
+    ''' Returns the utf-8 encoded XML document whose root element is \
+        tag with attrs, and whose content is the SaveFragments given '''
+    buf = StringIO()
+    out = FragmentGenerator(buf, "utf-8")
+    out.startDocument()
+    out.startElement(tag, OrderedDict(attrs))
+    for fragment in fragments:
+        out.raw(fragment.get_text())
+    out.endElement(tag)
+    out.endDocument()
+    return buf.getvalue().encode("utf-8")
+
 __BE_VERBOSE=os.environ.get('DEBUG_LABYRINTH',0)
 if __BE_VERBOSE:
     def print_debug(*data):
@@ -58,6 +147,20 @@ else:
 # FIXME: this is a no-go, but fast and efficient
 # global variables
 use_bezier_curves = True
+# Render every thought once into its own surface and composite those
+# (see BaseThought.draw_cached) instead of redrawing them on every expose
+use_render_cache = False
+# How far (in screen pixels) simplifying a finished drawing stroke may
+# move it.  0 keeps every point.
+stroke_tolerance = 0.5
+# Save each drawing stroke as one <stroke> element holding its packed
+# coordinates, rather than one <point> element per sample.  Older
+# versions can't read these, so it is off by default.
+compact_strokes = False
+# Compress saved maps with one of port.tarball.COMPRESSIONS ('gzip',
+# 'xz', ...), or None for a plain tar.  Compressed maps are zip files,
+# which older versions can read as well.
+save_compression = None
 default_colors = {
     "text" : (0.0, 0.0, 0.0),
     "fg" : (0.0, 0.0, 0.0),
@@ -114,13 +217,36 @@ def get_save_dir ():
         os.makedirs (dirname)
     return dirname
 
+# Coordinates are saved as str((x, y)), e.g. "(12.0, 34.5)".  Older
+# versions saved the map translation as a list, "[12.0, 34.5]", which
+# parse_coords accepts too.  This matches a list of tuples joined by
+# newlines; float() checks the numbers.
+COORDS_PAIR = r'\([^,()\n]+,[^,()\n]+\)'
+COORDS_LIST_RE = re.compile (r'(?:%s\n)*%s\Z' % (COORDS_PAIR, COORDS_PAIR))
+
 def parse_coords (string):
+    ''' Returns the (x, y) tuple saved in string, or None for "None".  \
+        Raises ValueError if string isn't a pair of numbers '''
     if string == "None":
         return None
-    local = string[1:string.find(',')]
-    local_2 = string[string.find (',')+1:string.find(')')]
-    coord = (float(local),    float(local_2))
-    return coord
+    if (string[:1], string[-1:]) not in (("(", ")"), ("[", "]")):
+        raise ValueError ("Invalid coordinates: %r" % (string,))
+    x, y = string[1:-1].split (",")
+    return (float (x), float (y))
+
+def parse_coords_list (strings):
+    ''' Like parse_coords for a whole list of strings.  They are checked \
+        with one regular expression match and converted in bulk '''
+    joined = "\n".join (strings)
+    if not strings or not COORDS_LIST_RE.match (joined):
+        # Let parse_coords deal with "None" or report what is wrong
+        return [parse_coords (string) for string in strings]
+    values = [float (value) for value in
+              joined.replace ("(", "").replace (")", "").replace ("\n", ",").split (",")]
+    if len (values) != 2 * len (strings):
+        # A string held a line break of its own
+        return [parse_coords (string) for string in strings]
+    return list (zip (values[0::2], values[1::2]))
 
 __data_dir = None
 
@@ -251,23 +377,105 @@ def export_thought_outline (context, ul, lr, background_color, am_root = False,
     real_lr = (lr[0]+move[0], lr[1]+move[1])
     draw_thought_extended (context, real_ul, real_lr, False, am_primary, background_color, style == STYLE_EXTENDED_CONTENT)
 
-def pixbuf_to_cairo (pixel_array):
-    imgW, imgH = len(pixel_array[0]), len(pixel_array)
-    data = array('B', [0] * imgW * imgH * 4)
-    for y in range(imgH):
-        for x in range(imgW):
-            # cairo.FORMAT_ARGB32 uses pre-multiplied alpha
-            try:
-                alpha = pixel_array[y][x][3]
-            except:
-                alpha = 255
-            alpha_mul = float(alpha) / 255
-
-            offset = (x + (y * imgW)) * 4
-            data[offset] = int(int(pixel_array[y][x][2]) * alpha_mul) # B
-            data[offset+1] = int(int(pixel_array[y][x][1]) * alpha_mul) # G
-            data[offset+2] = int(int(pixel_array[y][x][0]) * alpha_mul) # R
-            data[offset+3] = alpha # A
-
+# For each byte of a cairo.FORMAT_ARGB32 pixel, the pixbuf channel it
+# comes from (3 being alpha).  Cairo stores native-endian words.
+if sys.byteorder == 'little':
+    CAIRO_CHANNELS = (2, 1, 0, 3)
+else:
+    CAIRO_CHANNELS = (3, 0, 1, 2)
+
+def pixbuf_to_cairo (pixbuf):
+    ''' Returns the pixels of pixbuf in the layout of cairo.FORMAT_ARGB32 \
+        (pre-multiplied alpha), 4 * width bytes per row '''
+    width, height = pixbuf.get_width (), pixbuf.get_height ()
+    channels = pixbuf.get_n_channels ()
+    rowstride = pixbuf.get_rowstride ()
+    has_alpha = pixbuf.get_has_alpha ()
+    pixels = pixbuf.get_pixels ()
+    if numpy is not None:
+        return _pixels_to_cairo_numpy (pixels, width, height, channels, rowstride, has_alpha)
+    return _pixels_to_cairo_bytes (pixels, width, height, channels, rowstride, has_alpha)
+
+def _pixels_to_cairo_numpy (pixels, width, height, channels, rowstride, has_alpha):
+    # The last row of a pixbuf isn't padded to the rowstride, so view
+    # the rows through strides rather than reshaping
+    source = numpy.lib.stride_tricks.as_strided (numpy.frombuffer (pixels, numpy.uint8),
+                                                 (height, width, channels),
+                                                 (rowstride, channels, 1))
+    data = numpy.empty ((height, width, 4), numpy.uint8)
+    if has_alpha:
+        alpha = source[..., 3].astype (numpy.uint16)
+    for i, channel in enumerate (CAIRO_CHANNELS):
+        if channel == 3:
+            data[..., i] = source[..., 3] if has_alpha else 255
+        elif has_alpha:
+            data[..., i] = (source[..., channel] * alpha + 127) // 255
+        else:
+            data[..., i] = source[..., channel]
+    return bytearray (data.tobytes ())
+
+# For each bit of a byte, the table translating bytes with that bit set
+# to 0xff and all others to 0
+_BIT_MASKS = [bytes (bytearray (0xff if value >> bit & 1 else 0 for value in range (256)))
+              for bit in range (8)]
+
+def _to_lanes (low, high):
+    ''' One integer with a 16 bit lane per byte of low, holding that \
+        byte and the one of high at the same position '''
+    lanes = bytearray (2 * len (low))
+    lanes[0::2] = low
+    lanes[1::2] = high
+    return int.from_bytes (bytes (lanes), 'little')
+
+def _premultiply (channels, alpha):
+    ''' Returns each of the bytes in channels multiplied by the bytes \
+        alpha / 255, rounded.  Python's big integers do the work: every \
+        value gets a 16 bit lane, and multiplying by alpha is done as a \
+        sum of shifts, one per bit of alpha, over all lanes at once '''
+    count = len (alpha)
+    # Lanes that are all ones where alpha has the bit set
+    masks = []
+    for bit in range (8):
+        bits = alpha.translate (_BIT_MASKS[bit])
+        if bits.count (0) != count:
+            masks.append ((bit, _to_lanes (bits, bits)))
+    low = int.from_bytes (b'\xff\x00' * count, 'little')
+    half = int.from_bytes (b'\x80\x00' * count, 'little')
+    results = []
+    for values in channels:
+        value_lanes = _to_lanes (values, bytes (count))
+        # t = value * alpha + 128, then (t + (t >> 8)) >> 8 is the
+        # value * alpha / 255 rounded, without dividing
+        total = half
+        for bit, mask in masks:
+            total += (value_lanes & mask) << bit
+        total += (total >> 8) & low
+        total = (total >> 8) & low
+        results.append (total.to_bytes (2 * count, 'little')[0::2])
+    return results
+
+def _pixels_to_cairo_bytes (pixels, width, height, channels, rowstride, has_alpha):
+    # Drop the padding at the end of the rows first, so every channel
+    # can be taken out of the whole picture with one slice
+    row_size = width * channels
+    if rowstride == row_size:
+        packed = bytes (pixels[:row_size * height])
+    else:
+        packed = b''.join ([bytes (pixels[y * rowstride:y * rowstride + row_size])
+                            for y in range (height)])
+    alpha = packed[3::channels] if has_alpha else None
+    if alpha is not None and not alpha.translate (None, b'\xff'):
+        # Opaque after all
+        alpha = None
+    if alpha is not None:
+        premultiplied = _premultiply ([packed[channel::channels] for channel in range (3)], alpha)
+    data = bytearray (width * height * 4)
+    for i, channel in enumerate (CAIRO_CHANNELS):
+        if channel == 3:
+            data[i::4] = alpha if alpha is not None else b'\xff' * (width * height)
+        elif alpha is None:
+            data[i::4] = packed[channel::channels]
+        else:
+            data[i::4] = premultiplied[channel]
     return data
 
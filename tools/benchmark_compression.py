@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# benchmark_compression.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+"""Compares the compression modes of saved maps.
+
+Each mode (a plain tar, then every name in tarball.COMPRESSIONS) saves
+the same map the way write_file does: the manifest compressed, the
+images stored as they are.  The archive size, the time to save it and
+the time to load it back (streaming the manifest through iterparse
+and reading every image) are reported.
+
+The map is either a saved map given with --map, or a synthetic one
+with label thoughts, drawings of --points points each and a few
+incompressible images standing in for photos.
+
+Needs PyGObject with GdkPixbuf; no display is needed.
+
+    python3 tools/benchmark_compression.py
+    python3 tools/benchmark_compression.py --map ~/map.tar
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from xml.etree import ElementTree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
+
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('GdkPixbuf', '2.0')
+
+from port import tarball
+from port.tarball import Tarball
+
+
+def make_map(n_thoughts, n_drawings, n_points, n_images, image_size,
+             seed=0):
+    """Returns (manifest, [(name, data), ...]) for a synthetic map"""
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n'
+           '<MMap title="benchmark" mode="0" scale_factor="1.0" '
+           'translation="(0.0, 0.0)">']
+    identity = 0
+    for i in range(n_thoughts):
+        x, y = rand.uniform(0, 5000), rand.uniform(0, 5000)
+        out.append('<label_thought cursor="0" ul-coords="(%r, %r)" '
+                   'lr-coords="(%r, %r)" identity="%d" '
+                   'background-color="#ffffffffffff" '
+                   'foreground-color="#000000000000" edge="False">'
+                   '<attribute start="0" end="7" type="bold"/>'
+                   'Thought number %d</label_thought>'
+                   % (x, y, x + 100, y + 70, identity, i))
+        identity += 1
+    for i in range(n_drawings):
+        out.append('<drawing_thought ul-coords="(0.0, 0.0)" '
+                   'lr-coords="(500.0, 500.0)" identity="%d" '
+                   'background-color="#ffffffffffff" '
+                   'foreground-color="#000000000000" min_x="0.0" '
+                   'min_y="0.0" max_x="500.0" max_y="500.0">' % identity)
+        identity += 1
+        x, y = 250.0, 250.0
+        for p in range(n_points):
+            x += rand.uniform(-3, 3)
+            y += rand.uniform(-3, 3)
+            style = 2 if p == 0 else (1 if p == n_points - 1 else 0)
+            out.append('<point coords="(%r, %r)" type="%d" '
+                       'color="#000000000000"/>' % (x, y, style))
+        out.append('</drawing_thought>')
+    for i in range(n_images):
+        out.append('<image_thought ul-coords="(0.0, 0.0)" '
+                   'lr-coords="(400.0, 300.0)" identity="%d" '
+                   'file="image%d.png" image_width="400" '
+                   'image_height="300"/>' % (identity, i))
+        identity += 1
+    for i in range(n_thoughts):
+        out.append('<link start="(0.0, 0.0)" end="(10.0, 10.0)" '
+                   'strength="2" color="(0.0, 0.0, 0.0)" child="%d" '
+                   'parent="%d"/>' % (rand.randrange(identity),
+                                      rand.randrange(identity)))
+    out.append('</MMap>')
+    images = [('image%d.png' % i, os.urandom(image_size))
+              for i in range(n_images)]
+    return ''.join(out).encode('utf-8'), images
+
+
+def read_map(path):
+    """Returns (manifest, [(name, data), ...]) of a saved map"""
+    tar = Tarball(path)
+    names = tar.getnames()
+    manifest = tar.read(names[0])
+    files = [(name, tar.read(name)) for name in names[1:]]
+    tar.close()
+    return manifest, files
+
+
+def save(path, compression, manifest, files):
+    tar = Tarball(path, 'w', compression=compression)
+    tar.write('MANIFEST', manifest)
+    for name, data in files:
+        tar.write(name, data, compress=False)
+    tar.close()
+
+
+def load(path):
+    tar = Tarball(path)
+    names = tar.getnames()
+    manifest = tar.open(names[0])
+    elements = 0
+    for event, node in ElementTree.iterparse(manifest):
+        elements += 1
+    manifest.close()
+    for name in names[1:]:
+        tar.read(name)
+    tar.close()
+    return elements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--map', help='a saved map to use')
+    parser.add_argument('--thoughts', type=int, default=500)
+    parser.add_argument('--drawings', type=int, default=20)
+    parser.add_argument('--points', type=int, default=2000)
+    parser.add_argument('--images', type=int, default=3)
+    parser.add_argument('--image-size', type=int, default=300 * 1024,
+                        help='bytes per image')
+    args = parser.parse_args()
+
+    if args.map:
+        manifest, files = read_map(args.map)
+    else:
+        manifest, files = make_map(args.thoughts, args.drawings,
+                                   args.points, args.images,
+                                   args.image_size)
+    print('manifest: %.2f MB, %d other files, %.2f MB'
+          % (len(manifest) / 1e6, len(files),
+             sum(len(data) for name, data in files) / 1e6))
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('%-6s %10s %9s %9s' % ('mode', 'size (MB)', 'save (s)',
+                                     'load (s)'))
+        for compression in [None] + sorted(tarball.COMPRESSIONS):
+            path = os.path.join(directory, str(compression))
+            start = time.time()
+            save(path, compression, manifest, files)
+            saving = time.time() - start
+            start = time.time()
+            load(path)
+            loading = time.time() - start
+            print('%-6s %10.2f %9.3f %9.3f'
+                  % (compression or 'none', os.path.getsize(path) / 1e6,
+                     saving, loading))
+            os.remove(path)
+    finally:
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
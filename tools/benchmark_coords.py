@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# benchmark_coords.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+"""Checks and times utils.parse_coords and utils.parse_coords_list.
+
+First the strings saved maps contain (including the "[x, y]" form
+older versions saved the translation in) are checked to parse, and
+malformed ones to raise ValueError.  Then --count coordinate strings,
+as found in the <point> elements of drawings, are parsed with the
+string slicing parse_coords used to do, with parse_coords one by one,
+and with parse_coords_list in one go.
+
+Needs PyGObject, as utils imports Gdk; no display is needed.
+
+    python3 tools/benchmark_coords.py --count 200000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
+
+import gi
+gi.require_version('Gdk', '3.0')
+gi.require_version('GdkPixbuf', '2.0')
+
+import utils
+
+VALID = [("(12.0, 34.5)", (12.0, 34.5)),
+         ("(-0.25, 1e3)", (-0.25, 1000.0)),
+         ("(12, 34)", (12.0, 34.0)),
+         ("( 1.0 ,2.0 )", (1.0, 2.0)),
+         # The translation of maps saved by older versions
+         ("[0.0, 0.0]", (0.0, 0.0)),
+         ("[-120.5, 33.0]", (-120.5, 33.0)),
+         ("None", None)]
+
+INVALID = ["",
+           "()",
+           "(1.0)",
+           "(1.0, 2.0",
+           "1.0, 2.0)",
+           "(1.0, 2.0]",
+           "[1.0, 2.0)",
+           "(1.0, 2.0, 3.0)",
+           "(a, b)",
+           "(1.0, 2.0)x"]
+
+
+def old_parse_coords(string):
+    """What parse_coords did before"""
+    if string == "None":
+        return None
+    local = string[1:string.find(',')]
+    local_2 = string[string.find(',') + 1:string.find(')')]
+    return (float(local), float(local_2))
+
+
+def check():
+    failures = []
+    for string, expected in VALID:
+        try:
+            found = utils.parse_coords(string)
+        except ValueError as e:
+            found = e
+        if found != expected:
+            failures.append('parse_coords(%r) gave %r' % (string, found))
+    for string in INVALID:
+        try:
+            found = utils.parse_coords(string)
+        except ValueError:
+            continue
+        failures.append('parse_coords(%r) gave %r' % (string, found))
+
+    strings = [string for string, expected in VALID]
+    found = utils.parse_coords_list(strings)
+    if found != [expected for string, expected in VALID]:
+        failures.append('parse_coords_list(%r) gave %r' % (strings, found))
+    for string in INVALID:
+        try:
+            found = utils.parse_coords_list(["(1.0, 2.0)", string])
+        except ValueError:
+            continue
+        failures.append('parse_coords_list accepted %r' % string)
+
+    if failures:
+        sys.exit('\n'.join(failures))
+    print('%d strings parsed as expected' % (len(VALID) + len(INVALID)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=200000)
+    args = parser.parse_args()
+
+    check()
+
+    rand = random.Random(0)
+    strings = [str((rand.uniform(0, 1000), rand.uniform(0, 1000)))
+               for i in range(args.count)]
+    ways = [('old slicing', lambda: [old_parse_coords(s) for s in strings]),
+            ('parse_coords', lambda: [utils.parse_coords(s)
+                                      for s in strings]),
+            ('parse_coords_list', lambda: utils.parse_coords_list(strings))]
+    results = []
+    for name, parse in ways:
+        start = time.time()
+        results.append(parse())
+        print('%-18s %8.3f s' % (name, time.time() - start))
+    if any(result != results[0] for result in results[1:]):
+        sys.exit('the parsers disagree')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# benchmark_eraser.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+"""Replays an eraser gesture over a synthetic drawing.
+
+The drawing has --strokes wavy strokes of --points points each,
+stacked on top of each other.  The eraser then zig-zags across all of
+them, and every pointer motion goes through
+DrawingThought.handle_motion, as when erasing with shift held down.
+The total time and the slowest motion event are reported; for the
+eraser to keep up with the pointer, an event should take a few
+milliseconds at most.
+
+Needs PyGObject with GTK 3.
+
+    python3 tools/benchmark_eraser.py --strokes 20 --points 5000
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
+
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
+from gi.repository import Gdk
+
+import UndoManager
+import DrawingThought
+
+# Distance between points of a stroke, between strokes, and between
+# the pointer positions of the eraser gesture
+POINT_SPACING = 0.5
+STROKE_SPACING = 12
+GESTURE_STEP = 2.0
+
+
+def make_drawing(n_strokes, n_points):
+    black = Gdk.Color(0, 0, 0)
+    white = Gdk.Color(65535, 65535, 65535)
+    thought = DrawingThought.DrawingThought((0, 0), None, 0,
+                                            UndoManager.UndoManager(None),
+                                            False, white, black)
+    for s in range(n_strokes):
+        stroke = DrawingThought.Stroke(black)
+        base = s * STROKE_SPACING
+        for i in range(n_points):
+            stroke.append(i * POINT_SPACING, base + 5 * math.sin(i / 40.0))
+        thought.strokes.append(stroke)
+    thought.ul = (-10, -10)
+    thought.lr = (n_points * POINT_SPACING + 10,
+                  n_strokes * STROKE_SPACING + 10)
+    return thought
+
+
+def gesture(width, height, passes):
+    """Pointer positions zig-zagging passes times over the drawing"""
+    steps = int(width / GESTURE_STEP)
+    for p in range(passes):
+        for i in range(steps):
+            x = i * GESTURE_STEP
+            # Up and down the height of the drawing along the way
+            phase = (i * passes / float(steps) + p) % 2
+            y = height * (phase if phase < 1 else 2 - phase)
+            yield x, y
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--strokes', type=int, default=20)
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--passes', type=int, default=4,
+                        help='times the eraser crosses the drawing')
+    args = parser.parse_args()
+
+    thought = make_drawing(args.strokes, args.points)
+    # What process_button_down sets up for the eraser
+    thought.editing = True
+    thought.button_down = True
+    thought.drawing = 2
+    thought.edits = []
+
+    width = args.points * POINT_SPACING
+    height = args.strokes * STROKE_SPACING
+    events = 0
+    slowest = 0.0
+    start = time.time()
+    for coords in gesture(width, height, args.passes):
+        before = time.time()
+        thought.handle_motion(None, coords)
+        slowest = max(slowest, time.time() - before)
+        events += 1
+    spent = time.time() - start
+
+    print('drawing: %d strokes of %d points'
+          % (args.strokes, args.points))
+    print('events:   %8d' % events)
+    print('total:    %8.3f s' % spent)
+    print('mean:     %8.3f ms' % (spent * 1000 / max(events, 1)))
+    print('slowest:  %8.3f ms' % (slowest * 1000))
+    print('strokes left: %d, edits: %d'
+          % (len(thought.strokes), len(thought.edits)))
+
+
+if __name__ == '__main__':
+    main()
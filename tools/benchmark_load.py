@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# benchmark_load.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+"""Times loading a synthetic map into MMapArea.
+
+The map has --thoughts label thoughts on a grid and --links links
+between random pairs of them.  One link in a hundred points at a
+thought that doesn't exist, so finish_loading has dangling links to
+delete as well.
+
+Besides the whole load, the link resolution is timed the way
+finish_loading does it (one identity dictionary) and the way it used
+to (a scan of all thoughts per link).  The scan is timed over
+--sample links only and extrapolated, as running it over 20000 links
+takes minutes.
+
+Needs PyGObject with GTK 3 and a display (xvfb-run works).
+
+    python3 tools/benchmark_load.py --thoughts 10000 --links 20000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from io import BytesIO
+from xml.etree import ElementTree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
+
+import gi
+gi.require_version('Gtk', '3.0')
+
+import MMapArea
+import UndoManager
+from Links import Link
+
+# Thoughts per row of the grid, and the distance between them
+COLUMNS = 100
+SPACING = 150
+
+
+def make_manifest(n_thoughts, n_links, seed=0):
+    """Returns the MANIFEST of a map with n_thoughts label thoughts
+    and n_links links, as bytes."""
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n'
+           '<MMap title="benchmark" mode="0" scale_factor="1.0" '
+           'translation="(0.0, 0.0)">']
+    for i in range(n_thoughts):
+        x = (i % COLUMNS) * SPACING
+        y = (i // COLUMNS) * SPACING
+        extra = ' primary_root="true"' if i == 0 else ''
+        out.append('<label_thought cursor="0" ul-coords="(%.1f, %.1f)" '
+                   'lr-coords="(%.1f, %.1f)" identity="%d" '
+                   'background-color="#ffffffffffff" '
+                   'foreground-color="#000000000000" edge="False"%s>'
+                   'thought %d</label_thought>'
+                   % (x, y, x + 100, y + 70, i, extra, i))
+    for i in range(n_links):
+        parent = rand.randrange(n_thoughts)
+        child = rand.randrange(n_thoughts - 1)
+        if child >= parent:
+            child += 1
+        if i % 100 == 99:
+            # Dangling
+            child = n_thoughts + i
+        out.append('<link start="(0.0, 0.0)" end="(10.0, 10.0)" '
+                   'strength="2" color="(0.0, 0.0, 0.0)" '
+                   'child="%d" parent="%d"/>' % (child, parent))
+    out.append('</MMap>')
+    return ''.join(out).encode('utf-8')
+
+
+def load(manifest):
+    """Loads manifest into a new MMapArea the way read_file does.
+    Returns the area and the time spent in finish_loading."""
+    area = MMapArea.MMapArea(UndoManager.UndoManager(None))
+
+    spent = []
+    finish_loading = area.finish_loading
+
+    def timed_finish_loading():
+        start = time.time()
+        finish_loading()
+        spent.append(time.time() - start)
+    area.finish_loading = timed_finish_loading
+
+    events = ElementTree.iterparse(BytesIO(manifest),
+                                   events=('start', 'end'))
+    event, top_element = next(events)
+    area.load_thyself(top_element, events, None)
+    return area, spent[0]
+
+
+def resolve_by_identity(thoughts, links):
+    by_identity = {}
+    for t in thoughts:
+        by_identity.setdefault(t.identity, t)
+    return [(by_identity.get(l.parent_number),
+             by_identity.get(l.child_number)) for l in links]
+
+
+def resolve_by_scanning(thoughts, links):
+    """The lookup finish_loading used to do"""
+    found = []
+    for l in links:
+        parent = child = None
+        for t in thoughts:
+            if t.identity == l.parent_number:
+                parent = t
+            elif t.identity == l.child_number:
+                child = t
+            if parent and child:
+                break
+        found.append((parent, child))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--thoughts', type=int, default=10000)
+    parser.add_argument('--links', type=int, default=20000)
+    parser.add_argument('--sample', type=int, default=500,
+                        help='links to time the old scan over')
+    args = parser.parse_args()
+
+    manifest = make_manifest(args.thoughts, args.links)
+    print('manifest: %d thoughts, %d links, %.1f MB'
+          % (args.thoughts, args.links, len(manifest) / 1e6))
+
+    start = time.time()
+    area, finishing = load(manifest)
+    print('load:           %8.3f s (finish_loading %.3f s)'
+          % (time.time() - start, finishing))
+    print('links kept:     %8d' % len(area.links))
+
+    # Links as they were before resolution, for the lookups below
+    links = []
+    for node in ElementTree.fromstring(manifest).iter('link'):
+        l = Link()
+        l.load(node)
+        links.append(l)
+
+    start = time.time()
+    resolve_by_identity(area.thoughts, links)
+    print('identity dict:  %8.3f s' % (time.time() - start))
+
+    sample = links[:args.sample]
+    start = time.time()
+    resolve_by_scanning(area.thoughts, sample)
+    spent = time.time() - start
+    print('old scan:       %8.3f s (%.3f s for %d links, extrapolated)'
+          % (spent * len(links) / max(len(sample), 1), spent, len(sample)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# benchmark_pixbuf_to_cairo.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+"""Times utils.pixbuf_to_cairo on 1 to 12 megapixel images.
+
+Each size is converted with and without an alpha channel, through
+the numpy path (when numpy is installed) and the plain bytes path
+used on machines without it.  Before timing, both paths are checked
+to give the same bytes on a small image.
+
+Needs PyGObject with GdkPixbuf; no display is needed.
+
+    python3 tools/benchmark_pixbuf_to_cairo.py --sizes 1 4 12
+"""
+
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
+
+import gi
+gi.require_version('Gdk', '3.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import utils
+
+
+def make_pixbuf(width, height, has_alpha):
+    """A pixbuf of random pixels whose rows are padded, like the ones
+    GdkPixbuf decodes."""
+    channels = 4 if has_alpha else 3
+    rowstride = (width * channels + 7) & ~7
+    data = os.urandom(rowstride * height)
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+                                           GdkPixbuf.Colorspace.RGB,
+                                           has_alpha, 8, width, height,
+                                           rowstride)
+
+
+def converters():
+    """(name, function) for each way of converting a pixbuf"""
+    def convert_with(function):
+        def convert(pixbuf):
+            return function(pixbuf.get_pixels(), pixbuf.get_width(),
+                            pixbuf.get_height(), pixbuf.get_n_channels(),
+                            pixbuf.get_rowstride(), pixbuf.get_has_alpha())
+        return convert
+    found = []
+    if utils.numpy is not None:
+        found.append(('numpy', convert_with(utils._pixels_to_cairo_numpy)))
+    found.append(('bytes', convert_with(utils._pixels_to_cairo_bytes)))
+    return found
+
+
+def check():
+    for has_alpha in (False, True):
+        pixbuf = make_pixbuf(97, 31, has_alpha)
+        results = [convert(pixbuf) for name, convert in converters()]
+        for result in results[1:]:
+            if result != results[0]:
+                sys.exit('numpy and bytes paths differ (alpha: %s)'
+                         % has_alpha)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 12],
+                        help='image sizes in megapixels')
+    args = parser.parse_args()
+
+    check()
+    if utils.numpy is None:
+        print('numpy is not installed; timing the bytes path only')
+
+    print('%4s %6s %6s %9s' % ('MP', 'alpha', 'path', 'seconds'))
+    for megapixels in args.sizes:
+        # 4:3 images, as cameras take them
+        width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+        height = int(megapixels * 1e6 / width)
+        for has_alpha in (False, True):
+            pixbuf = make_pixbuf(width, height, has_alpha)
+            for name, convert in converters():
+                start = time.time()
+                convert(pixbuf)
+                print('%4d %6s %6s %9.3f' % (megapixels, has_alpha, name,
+                                             time.time() - start))
+
+
+if __name__ == '__main__':
+    main()